@@ -1,28 +1,60 @@
 """Finite State Machine implementation"""
-from FSM_rules import Rules
-from keypad import Keypad
-from LED_board import LEDBoard
+import inspect
+import time
+from FSM_rules import KPC_TRANSITIONS
+from kpc_logging import get_logger
+
+logger = get_logger('fsm')
 
 
 class FSM:
     """Class for implementing the Finite State Machine"""
 
-    def __init__(self, agent):
-        """Initializer function"""
+    def __init__(self, agent, tracer=None, checkpointer=None):
+        """Initializer function. tracer is an optional tracing.Tracer told
+        about every transition and signal wait, checkpointer an optional
+        checkpoint.Checkpointer saving the FSM's progress after every signal"""
         self.current_state = None  # Current state of the finite state machine
         self.start_state = 'S-Init'
 
         self.agent = agent         # Pointer back to agent
+        self.signals = agent.signal_stream()  # The agent's signals, read one at a time
         self.rules = []            # List of rules the FSM implements
+        self.dispatch = None       # (state_1, signal) -> rule, compiled lazily from self.rules
+        self.tracer = tracer
+        self.checkpointer = checkpointer
 
     def add_rule(self, rule):
         """Add a new rule to the end of the FSM rules list"""
         self.rules.append(rule)
+        # The rule set changed, so the dispatch table must be rebuilt
+        self.dispatch = None
+
+    def compile_rules(self):
+        """Build the dispatch table from the rules list. Wildcard signal
+        classes are expanded to one entry per signal, and earlier rules
+        win over later ones, just as in a linear first-match scan"""
+        dispatch = {}
+        for rule in self.rules:
+            for signal in rule.signals():
+                dispatch.setdefault((rule.state_1, signal), rule)
+        self.dispatch = dispatch
+
+    def lookup(self, next_signal):
+        """Return the first rule matching the current state and signal, or None"""
+        if self.dispatch is None:
+            self.compile_rules()
+        return self.dispatch.get((self.current_state, next_signal))
 
     def get_next_signal(self):
-        """Query the agent for the next signal"""
+        """Read the next signal from the agent's signal stream"""
 
-        next_signal = self.agent.get_next_signal()
+        if self.tracer is None:
+            return next(self.signals)
+
+        start = time.perf_counter()
+        next_signal = next(self.signals)
+        self.tracer.signal_wait(self.current_state, next_signal, time.perf_counter() - start)
 
         return next_signal
 
@@ -30,134 +62,149 @@ class FSM:
         """Start in FSMs init state and repeatedly call g_n_s() and
         run the rules one by one until reaching the final state"""
 
-        for rule in self.rules:
-            if self.match(rule, next_signal):
-                self.fire(rule)
-                break   # break after first match
+        rule = self.lookup(next_signal)
+        if rule is None:
+            self.no_match(next_signal)
+            return
 
-        print('No match - find error!')
+        self.fire(rule)
+
+    def no_match(self, next_signal):
+        """Report a signal no rule matches in the current state"""
+        logger.warning('No match for signal %s in state %s', next_signal, self.current_state)
+        if self.tracer is not None:
+            self.tracer.no_match(self.current_state, next_signal)
 
     def match(self, rule, next_signal):
         """ Check whether rule condition is fulfilled """
         # Check signal matches, Check state matches
-
-        if next_signal in rule.signal and self.current_state == rule.state_1:
-
-            # Match found
-            self.fire(rule)
-
-            return True
-
-        return False
+        return self.current_state == rule.state_1 and next_signal in rule.signals()
 
     def fire(self, rule):
         """Use consequent of a rule to
         a) set next state(state2) of the FSM and
         b) call the appropriate agent action method"""
 
-        self.current_state = rule.state2
-
-        rule.agent_action()
-
-    def is_final_state(self):
-
-        if self.current_state == 'S-Active' and self.get_next_signal() == '#':
-
-            return True
-
-        return False
+        if self.tracer is not None:
+            self.fire_traced(rule)
+            return
 
-    def create_rules(self):
-        """ Method that creates rule objects from the Rule class """
+        self.current_state = rule.state_2
 
-        # All possible signals
-        all_signals = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '*', '#']
-
-        # A1 for first iteration
-        rule1 = Rules('S-init', all_signals, 'S-Read', self.agent.wake_up_sequence())
+        rule.agent_action()
 
-        # A2
-        rule2 = Rules('S-Read', all_signals[:10], 'S-Read', self.agent.append_next_password_digit())
+    def fire_traced(self, rule):
+        """As fire, timing the agent action for the tracer"""
 
-        # A3
-        rule3 = Rules('S-Read', all_signals[10], 'S-Verify', self.agent.verify_password())
+        self.current_state = rule.state_2
 
-        # A4
-        rule4 = Rules('S-Verify', all_signals, 'S-init', self.agent.reset_password_entry())
+        start = time.perf_counter()
+        rule.agent_action()
+        self.tracer.transition(rule.state_1, rule.state_2, rule.agent_action.__name__,
+                               time.perf_counter() - start)
 
-        # A5
-        rule5 = Rules('S-Verify', 'Y', 'S-Active', self.agent.fully_activate_agent())
+    async def run_async(self, next_signal):
+        """As run, but an agent action may be a coroutine, which is awaited"""
 
-        # A4
-        rule6 = Rules('S-Read', all_signals, 'S-init', self.agent.clear_buffer())
+        rule = self.lookup(next_signal)
+        if rule is None:
+            self.no_match(next_signal)
+            return
 
-        # A1
-        rule7 = Rules('S-Active', all_signals[10], 'S-Read-2', self.agent.reset_password_entry())
+        await self.fire_async(rule)
 
-        # Choose a LED id
-        rule8 = Rules('S-Active', all_signals[:6], 'S-Led', self.agent.set_led_id())
+    async def fire_async(self, rule):
+        """As fire, awaiting the action if it returns an awaitable
+        (a coroutine, or an LED animation handle)"""
 
-        # Choose a LED duration
-        rule9 = Rules('S-time', all_signals[:10], 'S-time', self.agent.set_led_duration())  # Evt kall append_next_password_digit()
+        self.current_state = rule.state_2
 
-        # Complete duration
-        rule10 = Rules('S-time', all_signals[10],'S-Active', self.agent.light_one_led())
+        if self.tracer is None:
+            result = rule.agent_action()
+            if inspect.isawaitable(result):
+                await result
+            return
 
-        # A6
-        rule16 = Rules('S-Read-2', all_signals, 'S-Active', self.agent.reset_password_entry())
+        start = time.perf_counter()
+        result = rule.agent_action()
+        if inspect.isawaitable(result):
+            await result
+        self.tracer.transition(rule.state_1, rule.state_2, rule.agent_action.__name__,
+                               time.perf_counter() - start)
 
-        # A2
-        rule17 = Rules('S-Active', all_signals[:10], 'S-Read-2', self.agent.change_password())
+    def is_final_state(self):
+        """Return True once the user has confirmed logout"""
+        return self.current_state == 'S-Done'
+
+    def create_rules(self, transitions=KPC_TRANSITIONS):
+        """ Method that binds a compiled transition table to the agent.
+        The table is validated and compiled once, when FSM_rules is imported;
+        here each row only gets its agent method, called when its rule fires """
+        self.rules, self.dispatch = transitions.bind(self.agent)
+
+    def step(self):
+        """Get the next signal and run it through the rules"""
+        self.run(self.get_next_signal())
+        if self.checkpointer is not None:
+            self.checkpointer.save()
+
+    def start(self):
+        """Create the rules and enter the start state, or resume where the
+        checkpoint left off. A resumed system is already awake, so it skips
+        waiting for the wake-up key and its light show"""
 
-        # A7
-        rule18 = Rules('S-Read-2', all_signals[10], 'S-Read-3', self.agent.cache_new_password())
+        # Create all rule objects
+        self.create_rules()
+        logger.debug('Rules created')
 
-        # A6
-        rule19 = Rules('S-Read-3', all_signals, 'S-Active', self.agent.reset_password_entry())
+        if self.checkpointer is not None and self.checkpointer.restore():
+            logger.debug('Current state: %s', self.current_state)
+            return
 
-        # LOGOUT RULES
-        # Confirm logout
-        rule11 = Rules('S-Active', all_signals[11], 'S-Confirm_Logout', self.agent.clear_buffer())
+        self.current_state = self.start_state
+        logger.debug('Current state: %s', self.current_state)
+        logger.info('--------------WAKE UP SYSTEM BY PRESSING ANY KEY----------')
+
+    def finish(self):
+        """Forget the checkpoint once the final state is reached, so the next start boots afresh"""
+        if self.checkpointer is not None:
+            self.checkpointer.clear()
+
+    async def drive_async(self):
+        """Run signals from the agent through the rules until reaching the final state.
+        Waiting for a signal does not block the event loop, so one loop can
+        drive many FSMs next to timers and other tasks"""
+        while not self.is_final_state():
+            if self.tracer is None:
+                next_signal = await self.agent.get_next_signal_async()
+            else:
+                start = time.perf_counter()
+                next_signal = await self.agent.get_next_signal_async()
+                self.tracer.signal_wait(self.current_state, next_signal, time.perf_counter() - start)
+            await self.run_async(next_signal)
+            if self.checkpointer is not None:
+                self.checkpointer.save()
 
-        # Actual logout
-        rule12 = Rules('S-Confirm_Logout', all_signals[11], 'S-Done', self.agent.logout_logic())
+    async def main_loop_async(self):
+        """Main sequence to run the FSM as a coroutine"""
 
-        rule_ = Rules('S-Done', all_signals, 'S-Active', self.agent.wake_up_sequence())
+        self.start()
 
-        # Logout cancelled
-        rule13 = Rules('S-Confirm_Logout', all_signals, 'S-Active', self.agent.clear_buffer())
+        await self.drive_async()
+        self.finish()
 
-        # Add all rule-tuples to a list
-        self.rules = [rule1, rule2, rule3, rule4, rule5, rule6, rule7, rule8, rule9, rule10, rule16,
-                      rule17, rule18, rule19, rule11, rule12, rule_, rule13]
+        # Shutdown agent, keypad, LED board etc. and let the power down sequence finish
+        await self.agent.exit_action()
 
     def main_loop(self):
         """Main sequence to run the FSM"""
 
-        # Create all rule objects
-        self.create_rules()
-        print('Rules created')
-
-        for rule in self.rules:
-            self.add_rule(rule)
-
-
-        led_board_obj = LEDBoard()
-        keypad_obj = Keypad()
-
-        self.current_state = self.start_state
-        print('Current state: ', self.current_state)
+        self.start()
 
         while not self.is_final_state():
-            print("Not Final State Loop")
-            keypad_obj.get_next_signal()
-            next_signal = self.agent.get_next_signal()
-            self.run(next_signal)
-
-            for rule in self.rules:
-                self.add_rule(rule)
-                self.match(rule, next_signal)
-
-        # Shutdown agent, keypad, LED board etc.
-        led_board_obj.powering_down()
-        self.agent.exit_action()
+            self.step()
+            logger.debug('Current state: %s', self.current_state)
+        self.finish()
+
+        # Shutdown agent, keypad, LED board etc. and let the power down sequence finish
+        self.agent.exit_action().wait()
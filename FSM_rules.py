@@ -1,3 +1,11 @@
+""" Rules and signal classes for the Finite State Machine """
+from types import MappingProxyType
+
+# Wildcard signal classes a rule can trigger on
+DIGITS = frozenset('0123456789')
+ALL_KEYS = DIGITS | frozenset('*#')
+
+
 class Rules:
     """ Class that defines states, signals and actions
     for each rule instance of the class """
@@ -7,3 +15,112 @@ class Rules:
         self.state_2 = state_2      # New state of FSM if this rule fires
         self.signal = signal       # Triggering signal
         self.agent_action = agent_action       # Agent will be instructed to perform this action if this rule fires
+
+    def signals(self):
+        """ Return every concrete signal this rule triggers on. All signals
+        are single characters, so a string like '*#' lists two of them """
+        return tuple(self.signal)
+
+
+class RuleTableError(ValueError):
+    """ Raised when a rule table fails validation """
+
+
+class TransitionTable:
+    """ Immutable transition table compiled from a declarative rule table.
+    rows is a tuple of (state_1, signal, state_2, action name) rows in
+    priority order, dispatch maps (state_1, signal) to the index of the
+    row that fires """
+
+    def __init__(self, rows, dispatch):
+        """ Constructor """
+        self.rows = rows
+        self.dispatch = dispatch
+
+    def bind(self, agent):
+        """ Return (rules, dispatch) for an agent: one Rules object per row,
+        calling the agent method named by the row, and the dispatch table
+        from (state_1, signal) to those rules """
+        rules = [Rules(state_1, signal, state_2, getattr(agent, action))
+                 for state_1, signal, state_2, action in self.rows]
+        return rules, {key: rules[index] for key, index in self.dispatch.items()}
+
+
+def compile_rule_table(rows, start_state, final_states, state_signals=None):
+    """ Validate a rule table and compile it into a TransitionTable.
+    A state should handle every signal in state_signals.get(state, ALL_KEYS).
+    Raises RuleTableError listing unreachable states, rules that can never
+    fire because earlier rules take all their signals, and states with
+    signals no rule handles """
+    rows = tuple(rows)
+    state_signals = state_signals or {}
+    problems = []
+
+    # Wildcard signal classes are expanded to one entry per signal, and
+    # earlier rows win over later ones, just as in a linear first-match scan
+    dispatch = {}
+    for index, (state_1, signal, _, action) in enumerate(rows):
+        claimed = [dispatch.setdefault((state_1, sig), index) == index for sig in signal]
+        if not any(claimed):
+            problems.append('rule %d (%s -> %s) is shadowed by earlier rules' % (index, state_1, action))
+
+    # Walk the table from the start state
+    edges = {}
+    for (state_1, _), index in dispatch.items():
+        edges.setdefault(state_1, set()).add(rows[index][2])
+    reachable = set()
+    todo = [start_state]
+    while todo:
+        state = todo.pop()
+        if state not in reachable:
+            reachable.add(state)
+            todo.extend(edges.get(state, ()))
+
+    states = {row[0] for row in rows} | {row[2] for row in rows}
+    for state in sorted(states - reachable):
+        problems.append('state %s is unreachable from %s' % (state, start_state))
+
+    for state in sorted(reachable - set(final_states)):
+        missing = sorted(sig for sig in state_signals.get(state, ALL_KEYS) if (state, sig) not in dispatch)
+        if missing:
+            problems.append('state %s has no transition for %s' % (state, ' '.join(missing)))
+
+    if problems:
+        raise RuleTableError('invalid rule table:\n  ' + '\n  '.join(problems))
+
+    return TransitionTable(rows, MappingProxyType(dispatch))
+
+
+# The KPC rules in priority order: (state_1, signal, state_2, KPC action)
+KPC_RULE_TABLE = (
+    ('S-Init', ALL_KEYS, 'S-Read', 'wake_up_sequence'),                      # A1 any key wakes the system up
+    ('S-Read', DIGITS, 'S-Read', 'append_next_password_digit'),              # A2 read the password digit by digit
+    ('S-Read', '*', 'S-Verify', 'verify_password'),                          # A3 '*' ends the password
+    ('S-Read', ALL_KEYS, 'S-Init', 'clear_buffer'),                          # A4 any other key aborts the login
+    ('S-Verify', 'Y', 'S-Active', 'fully_activate_agent'),                   # A5 password accepted
+    ('S-Verify', 'N', 'S-Read', 'clear_buffer'),                             # A4 password rejected, read it again
+    ('S-Active', '*', 'S-Read-2', 'reset_password_entry'),                   # A1 '*' starts a password change
+    ('S-Active', '012345', 'S-Led', 'set_led_id'),                           # Choose a LED id
+    ('S-Led', DIGITS, 'S-Time', 'set_led_duration'),                         # Choose a LED duration
+    ('S-Time', DIGITS, 'S-Time', 'set_led_duration'),
+    ('S-Time', '*', 'S-Active', 'light_one_led'),                            # Complete duration
+    ('S-Led', ALL_KEYS, 'S-Active', 'clear_buffer'),                         # LED cancelled
+    ('S-Time', ALL_KEYS, 'S-Active', 'clear_buffer'),
+    ('S-Read-2', DIGITS, 'S-Read-2', 'change_password'),                     # A2 read the new password digit by digit
+    ('S-Read-2', '*', 'S-Read-3', 'validate_passcode_change'),               # A7 '*' ends the new password
+    ('S-Read-2', ALL_KEYS, 'S-Active', 'clear_buffer'),                      # A6 password change cancelled
+    ('S-Read-3', 'YN', 'S-Active', 'clear_buffer'),                          # A6 password changed or rejected
+    ('S-Active', '#', 'S-Confirm_Logout', 'clear_buffer'),                   # Confirm logout
+    ('S-Confirm_Logout', '#', 'S-Done', 'logout_logic'),                     # Actual logout
+    ('S-Confirm_Logout', ALL_KEYS, 'S-Active', 'clear_buffer'),              # Logout cancelled
+    ('S-Active', ALL_KEYS, 'S-Active', 'clear_buffer'),                      # Not a LED id, ignore the key
+)
+
+# The verify states only ever see the KPC's override signals
+KPC_STATE_SIGNALS = {'S-Verify': 'YN', 'S-Read-3': 'YN'}
+
+# The states in which the digits typed are a password, which must not be logged or stored
+ENTRY_STATES = frozenset({'S-Read', 'S-Read-2'})
+
+# Compiled and validated once, when the module is imported
+KPC_TRANSITIONS = compile_rule_table(KPC_RULE_TABLE, 'S-Init', {'S-Done'}, KPC_STATE_SIGNALS)
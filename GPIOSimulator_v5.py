@@ -1,5 +1,13 @@
 """ Project 5 Simulator """
-from pynput.keyboard import Listener
+import asyncio
+import os
+import queue
+import threading
+import weakref
+
+from kpc_logging import get_logger
+
+logger = get_logger('gpio')
 
 PIN_CHARLIEPLEXING_0 = 0
 PIN_CHARLIEPLEXING_1 = 1
@@ -22,80 +30,193 @@ valid_pins = keypad_pins + charlieplexing_pins
 
 N_LEDS = 6
 
+# key presses from the keyboard buffered for get_key_event; further presses are dropped
+# (with a warning) until it catches up, so a simulator nobody reads keys from does not
+# grow without bound. A headless simulator's keys are scripted and all kept
+KEY_EVENT_BUFFER = 64
 
-class GPIOSimulator:
-    """ Simulate Raspberry Pi GPIO for Project 5 """
+
+def _build_charlieplexing_table():
+    """
+    Map every packed charlieplexing configuration to the LED it lights, or -1.
+    A configuration packs one bit per charlieplexing pin into three masks:
+    pins in output mode, pins in input mode and pins driven HIGH, and the
+    table is indexed by out_mask | in_mask << 3 | high_mask << 6
+    """
+    # the pin modes of the three LED groups, as (out_mask, in_mask)
+    groups = [(0b011, 0b100), (0b110, 0b001), (0b101, 0b010)]
+    table = [-1] * 512
+    for group_index, (out_mask, in_mask) in enumerate(groups):
+        out_position = [i for i in range(3) if out_mask >> i & 1]
+        # the first output pin HIGH and the second LOW lights the first LED of the group,
+        # the opposite lights the second one
+        for index_in_group, high_pin in enumerate(out_position):
+            table[out_mask | in_mask << 3 | (1 << high_pin) << 6] = group_index * 2 + index_in_group
+    return table
+
+
+CHARLIEPLEXING_TABLE = _build_charlieplexing_table()
+
+# the line show_leds_states logs for every LED state mask, built once
+LED_STATE_MESSAGES = tuple('LEDs[%s]' % ','.join('  %d: %s' % (i, 'ON ' if mask >> i & 1 else 'OFF')
+                                                 for i in range(N_LEDS))
+                           for mask in range(1 << N_LEDS))
+
+# bit masks over pin numbers
+CHARLIEPLEXING_MASK = sum(1 << pin for pin in charlieplexing_pins)
+KEYPAD_ROW_MASK = sum(1 << pin for pin in keypad_row_pins)
+KEYPAD_COL_MASK = sum(1 << pin for pin in keypad_col_pins)
+KEYPAD_MASK = KEYPAD_ROW_MASK | KEYPAD_COL_MASK
+_VALID_PINS = frozenset(valid_pins)
+
+# keypad keys and their (row, col) coordinates, in row-major order;
+# a key's position in this dict is its bit in the key state mask
+_KEY_COORD = {'1': (0, 0),
+              '2': (0, 1),
+              '3': (0, 2),
+              '4': (1, 0),
+              '5': (1, 1),
+              '6': (1, 2),
+              '7': (2, 0),
+              '8': (2, 1),
+              '9': (2, 2),
+              '*': (3, 0),
+              '0': (3, 1),
+              '#': (3, 2)}
+_KEY_BITS = {key: 1 << index for index, key in enumerate(_KEY_COORD)}
+# the keypad key for each bit of a scan_matrix bitmap
+keypad_keys = list(_KEY_COORD)
+# the (row pin bit, col pin bit) connected by each key
+_KEY_PIN_BITS = [(1 << (row + PIN_KEYPAD_ROW_0), 1 << (col + PIN_KEYPAD_COL_0))
+                 for row, col in _KEY_COORD.values()]
+
+
+class _KeyboardListener:
+    """
+    The single pynput keyboard listener of the process, shared by every
+    simulator that reads the real keyboard. pynput is only imported when
+    the first such simulator subscribes, so headless simulators never load it
+    """
 
     def __init__(self):
-        # pin modes
-        self.IN = 0
-        self.OUT = 1
-        self.__NO_SETUP = -1
+        self.__lock = threading.Lock()
+        self.__simulators = weakref.WeakSet()
+        self.__listener = None
+
+    def subscribe(self, simulator):
+        """ forward keyboard events to simulator, starting the listener if needed """
+        with self.__lock:
+            self.__simulators.add(simulator)
+            if self.__listener is None:
+                from pynput.keyboard import Listener
+                self.__listener = Listener(on_press=self.__on_press, on_release=self.__on_release)
+                self.__listener.start()
+
+    def __on_press(self, key):
+        """ The callback function for a key pressing event """
+        char = getattr(key, 'char', None)
+        for simulator in list(self.__simulators):
+            simulator.press_key(char)
+
+    def __on_release(self, key):
+        """ The callback function for any key releasing event """
+        char = getattr(key, 'char', None)
+        for simulator in list(self.__simulators):
+            simulator.release_key(char)
+
+
+_KEYBOARD = _KeyboardListener()
+
+
+def headless_by_default():
+    """ Simulators are headless unless told otherwise when the
+    GPIO_SIMULATOR_HEADLESS environment variable is set, e.g. in CI """
+    return os.environ.get('GPIO_SIMULATOR_HEADLESS', '').lower() in ('1', 'true', 'yes')
+
+
+def set_ready(future):
+    """ Wake the coroutine awaiting future, e.g. one waiting in get_key_event_async,
+    unless it gave up waiting. Called on the future's event loop """
+    if not future.done():
+        future.set_result(None)
+
+
+class GPIOSimulator:
+    """ Simulate Raspberry Pi GPIO for Project 5.
+    Pin modes, pin states, LED states and key states are each kept as an
+    integer bit mask, one bit per pin, LED or key.
+    A headless simulator does not read the keyboard, its keys are pressed
+    with press_key, release_key and feed_keys instead """
 
-        # pin states
-        self.LOW = 0
-        self.HIGH = 1
-        self.__NO_SIGNAL = -1
+    __slots__ = ('__setup_mask', '__out_mask', '__high_mask', '__led_mask', '__shown_mask', '__key_mask',
+                 '__key_latch', '__key_events', '__key_waiters', '__weakref__')
 
-        # led states
-        self.OFF = 0
-        self.ON = 1
+    # pin modes
+    IN = 0
+    OUT = 1
+
+    # pin states
+    LOW = 0
+    HIGH = 1
+
+    # led states
+    OFF = 0
+    ON = 1
+
+    def __init__(self, headless=None):
+        if headless is None:
+            headless = headless_by_default()
 
         # private members
-        self.__key_coord = {'1': (0, 0),
-                            '2': (0, 1),
-                            '3': (0, 2),
-                            '4': (1, 0),
-                            '5': (1, 1),
-                            '6': (1, 2),
-                            '7': (2, 0),
-                            '8': (2, 1),
-                            '9': (2, 2),
-                            '*': (3, 0),
-                            '0': (3, 1),
-                            '#': (3, 2)}
-        self.__valid_keys = self.__key_coord.keys()
-
-        self.__pin_modes = [self.__NO_SETUP] * len(valid_pins)
-        self.__pin_states = [self.__NO_SIGNAL] * len(valid_pins)
-        self.__led_states = [self.OFF] * N_LEDS
-        self.__key_states = [False] * len(self.__key_coord)
-
-        self.__listener = Listener(on_press=self.__on_press, on_release=self.__on_release)
-        self.__listener.start()
+        self.__setup_mask = 0   # pins that have a mode
+        self.__out_mask = 0     # pins in output mode
+        self.__high_mask = 0    # pins whose state is HIGH
+        self.__led_mask = 0     # LEDs lit since the last show_leds_states
+        self.__shown_mask = None    # LEDs show_leds_states logged last
+        self.__key_mask = 0     # pressed keys, bit order as in _KEY_COORD
+        self.__key_latch = 0    # keys pressed since the last read_key_edges
+        # pressed keypad keys, pushed by press_key
+        self.__key_events = queue.Queue(0 if headless else KEY_EVENT_BUFFER)
+        # (event loop, future) of coroutines waiting in get_key_event_async
+        self.__key_waiters = []
+
+        if not headless:
+            _KEYBOARD.subscribe(self)
 
     def setup(self, pin, mode, state=None):
         """ setup the initial mode and state of a specific pin """
         if state is None:  # set the default state to self.LOW
             state = self.LOW
-        assert pin in valid_pins, "Invalid pin!"
+        assert pin in _VALID_PINS, "Invalid pin!"
         assert mode in {self.IN, self.OUT}, "Invalid pin mode!"
-        self.__pin_modes[pin] = mode
         assert state in {self.LOW, self.HIGH}, "'Invalid pin state!"
-        self.__pin_states[pin] = state
+        bit = 1 << pin
+        self.__setup_mask |= bit
+        self.__out_mask = (self.__out_mask & ~bit) | (mode << pin)
+        self.__high_mask = (self.__high_mask & ~bit) | (state << pin)
 
-    def cleanup(self):
-        """ reset GPIO, i.e., clear mode and state of each pin """
-        for pin in valid_pins:
-            self.__pin_modes[pin] = self.__NO_SETUP
-            self.__pin_states[pin] = self.__NO_SIGNAL
+    def cleanup(self, pins=None):
+        """ reset GPIO, i.e., clear mode and state of each pin, or only of the given pins """
+        mask = ~0 if pins is None else ~sum(1 << pin for pin in pins)
+        self.__setup_mask &= mask
+        self.__out_mask &= mask
+        self.__high_mask &= mask
 
     def input(self, pin):
         """ Carry out hardware simulation and return the state of an input pin """
-        assert pin in valid_pins, "Invalid input pin"
-        assert self.__pin_modes[pin] == self.IN, "Pin{} is not in input mode!".format(pin)
-        if pin in keypad_pins:
+        assert pin in _VALID_PINS, "Invalid input pin"
+        assert (self.__setup_mask & ~self.__out_mask) >> pin & 1, "Pin{} is not in input mode!".format(pin)
+        if KEYPAD_MASK >> pin & 1:
             self.__update_keypad_pin_states()
-        return self.__pin_states[pin]
+        return self.__high_mask >> pin & 1
 
     def output(self, pin, state):
         """ set the state to an output pin, and carry out hardware simulation """
-        assert pin in valid_pins, "Invalid output pin"
-        assert self.__pin_modes[pin] == self.OUT, "Pin{} is not in output mode!".format(pin)
-        if pin in keypad_pins:
-            self.__pin_states[pin] = state
-        else:
-            self.__pin_states[pin] = state
+        assert pin in _VALID_PINS, "Invalid output pin"
+        assert self.__out_mask >> pin & 1, "Pin{} is not in output mode!".format(pin)
+        bit = 1 << pin
+        self.__high_mask = (self.__high_mask & ~bit) | (state << pin)
+        if CHARLIEPLEXING_MASK & bit:
             self.__update_led_states()
 
     def __update_keypad_pin_states(self):
@@ -103,85 +224,146 @@ class GPIOSimulator:
         internal function, called by GPIO.input
         Update the states of the keypad input pins
         """
+        in_mask = self.__setup_mask & ~self.__out_mask
         # reset all keypad pins whose mode is GPIO.IN to GPIO.LOW
-        for pin in keypad_pins:
-            if self.__pin_modes[pin] == self.IN:
-                self.__pin_states[pin] = self.LOW
+        high_mask = self.__high_mask & ~(in_mask & KEYPAD_MASK)
 
-        # if there is at least a True in the key states
-        if True in self.__key_states:
-            # find the first True
-            pressed_key_index = self.__key_states.index(True)
-
-            # retrieve the coordinates of the pressed
-            pressed_row, pressed_col = list(self.__key_coord.values())[pressed_key_index]
-
-            # get the corresponding pins
-            row_pin = pressed_row + PIN_KEYPAD_ROW_0
-            col_pin = pressed_col + PIN_KEYPAD_COL_0
+        key_mask = self.__key_mask
+        if key_mask:
+            # the lowest set bit is the first pressed key
+            row_bit, col_bit = _KEY_PIN_BITS[(key_mask & -key_mask).bit_length() - 1]
 
             # set the input pin state to True according to the connected lines
             # it could be row_pin IN and col_pin OUT
             # or row_pin OUT and col_pin IN
-            if self.__pin_modes[row_pin] == self.OUT and \
-                    self.__pin_states[row_pin] == self.HIGH and \
-                    self.__pin_modes[col_pin] == self.IN:
-                self.__pin_states[col_pin] = self.HIGH
-            elif self.__pin_modes[col_pin] == self.OUT and \
-                    self.__pin_states[col_pin] == self.HIGH and \
-                    self.__pin_modes[row_pin] == self.IN:
-                self.__pin_states[row_pin] = self.HIGH
+            driven = self.__out_mask & high_mask
+            if driven & row_bit and in_mask & col_bit:
+                high_mask |= col_bit
+            elif driven & col_bit and in_mask & row_bit:
+                high_mask |= row_bit
 
-    def __on_press(self, key):
-        """ The callback function for a key pressing event """
+        self.__high_mask = high_mask
+
+    def press_key(self, char):
+        """ Press a keypad key, as the keyboard listener does on a key pressing event """
         # We handle only valid keypad keys, while neglecting all others
         # still allowing Ctrl+C to quit
-        if hasattr(key, 'char') and key.char in self.__valid_keys:
-            # reset the key states
-            self.__key_states = [False] * len(self.__key_coord)
-            # set the pressed key's state to True
-            index = list(self.__key_coord.keys()).index(key.char)
-            self.__key_states[index] = True
+        if char in _KEY_BITS:
+            bit = _KEY_BITS[char]
+            # the keyboard's auto-repeat presses a held key again; that is not a new press
+            if self.__key_mask & bit:
+                return
+            # several keys may be held down at once
+            self.__key_mask |= bit
+            self.__key_latch |= bit
+            # notify anyone waiting in get_key_event
+            try:
+                self.__key_events.put_nowait(char)
+            except queue.Full:
+                logger.warning('Key event buffer full, dropped a key')
+            # the queue's lock also guards the waiters, so no waiter misses this key
+            with self.__key_events.mutex:
+                waiters, self.__key_waiters = self.__key_waiters, []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(set_ready, future)
 
-    def __on_release(self, key):
-        """ The callback function for any key releasing event """
-        # For simplicity, we reset the key states whenever a key is released
-        self.__key_states = [False] * len(self.__key_coord)
+    def get_key_event(self, timeout=None):
+        """ Block until a keypad key is pressed and return its symbol,
+        or return None if nothing was pressed within timeout seconds """
+        try:
+            return self.__key_events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def get_key_event_async(self):
+        """ Wait for a keypad key to be pressed without blocking the event loop,
+        and return its symbol """
+        loop = asyncio.get_running_loop()
+        while True:
+            char = self.get_key_event(0)
+            if char is not None:
+                return char
+
+            future = loop.create_future()
+            with self.__key_events.mutex:
+                # a key pressed since get_key_event did not wake this waiter
+                if self.__key_events.queue:
+                    continue
+                self.__key_waiters.append((loop, future))
+            await future
+
+    def release_key(self, char):
+        """ Release a keypad key, as the keyboard listener does on a key releasing event """
+        # only the released key goes up, any other held keys stay down
+        self.__key_mask &= ~_KEY_BITS.get(char, 0)
+
+    def feed_keys(self, keys):
+        """ Press and release each key from keys in turn, e.g. a scripted
+        key sequence such as '778899*' or a generator of keys """
+        for char in keys:
+            self.press_key(char)
+            self.release_key(char)
+
+    def read_key_edges(self):
+        """
+        Return (held, pressed): the bitmap of keys down now and of keys pressed
+        since the previous call, including keys released again since, in the
+        bit order of scan_matrix. Lets a poller see presses shorter than its interval
+        """
+        pressed, self.__key_latch = self.__key_latch, 0
+        return self.__key_mask, pressed
+
+    def scan_matrix(self):
+        """
+        Scan the whole keypad in one call and return the bitmap of pressed keys,
+        bit i set meaning keypad_keys[i] is down. This has the same result as driving
+        each row (or column) HIGH in turn and reading every other line, so the keypad
+        pins must be set up with the rows as outputs and the columns as inputs, or the reverse
+        """
+        in_mask = self.__setup_mask & ~self.__out_mask
+        assert (self.__out_mask & KEYPAD_MASK == KEYPAD_ROW_MASK and in_mask & KEYPAD_MASK == KEYPAD_COL_MASK) or \
+            (self.__out_mask & KEYPAD_MASK == KEYPAD_COL_MASK and in_mask & KEYPAD_MASK == KEYPAD_ROW_MASK), \
+            "Keypad pins are not set up for scanning!"
+        return self.__key_mask
+
+    def setup_charlieplexing(self, out_mask, high_mask):
+        """
+        Apply a whole LED configuration in one call: every charlieplexing pin
+        whose bit is set in out_mask becomes an output, driven HIGH if its bit
+        is set in high_mask and LOW otherwise, and every other one becomes an input
+        """
+        # the charlieplexing pins are pins 0-2, so the masks line up with the pin bits
+        out_mask &= CHARLIEPLEXING_MASK
+        high_mask &= out_mask
+        self.__setup_mask |= CHARLIEPLEXING_MASK
+        self.__out_mask = (self.__out_mask & ~CHARLIEPLEXING_MASK) | out_mask
+        self.__high_mask = (self.__high_mask & ~CHARLIEPLEXING_MASK) | high_mask
+        led_index = CHARLIEPLEXING_TABLE[out_mask | (out_mask ^ CHARLIEPLEXING_MASK) << 3 | high_mask << 6]
+        if led_index >= 0:
+            self.__led_mask |= 1 << led_index
+
+    def lit_led(self):
+        """ Return the LED the charlieplexing pins light right now, or -1 for none """
+        out_mask = self.__out_mask & CHARLIEPLEXING_MASK
+        in_mask = self.__setup_mask & ~self.__out_mask & CHARLIEPLEXING_MASK
+        return CHARLIEPLEXING_TABLE[out_mask | in_mask << 3 | (self.__high_mask & out_mask) << 6]
 
     def __update_led_states(self):
         """
         internal function, called by GPIO.output
-        set self.__led_states according to the CharliePlexing circuit, charlieplexing pin modes and states
+        set self.__led_mask according to the CharliePlexing circuit, charlieplexing pin modes and states
         """
-        valid_modes = [[self.OUT, self.OUT, self.IN],
-                       [self.IN, self.OUT, self.OUT],
-                       [self.OUT, self.IN, self.OUT]]
-        cp_pin_modes = self.__pin_modes[PIN_CHARLIEPLEXING_0:PIN_CHARLIEPLEXING_2 + 1]
-        if cp_pin_modes in valid_modes:
-            group_index = valid_modes.index(cp_pin_modes)
-        else:
-            return
-        out_position = [i for i, v in enumerate(cp_pin_modes) if v == self.OUT]
-        if self.__pin_states[out_position[0]] == self.HIGH and \
-                self.__pin_states[out_position[1]] == self.LOW:
-            index_in_group = 0
-        elif self.__pin_states[out_position[0]] == self.LOW and \
-                self.__pin_states[out_position[1]] == self.HIGH:
-            index_in_group = 1
-        else:
-            return
-        led_index = group_index * 2 + index_in_group
-        self.__led_states[led_index] = self.ON
+        out_mask = self.__out_mask & CHARLIEPLEXING_MASK
+        in_mask = self.__setup_mask & ~self.__out_mask & CHARLIEPLEXING_MASK
+        led_index = CHARLIEPLEXING_TABLE[out_mask | in_mask << 3 | (self.__high_mask & out_mask) << 6]
+        if led_index >= 0:
+            self.__led_mask |= 1 << led_index
 
     def show_leds_states(self):
-        """ Show the states of the six LEDs """
+        """ Show the states of the six LEDs, if they changed since they were last shown """
         self.__update_led_states()
-        state_strs = ['OFF', 'ON ']
-        msg = 'LEDs['
-        for i in range(N_LEDS):
-            comma = '' if i == 0 else ','
-            msg += "%s  %d: %s" % (comma, i, state_strs[self.__led_states[i]])
-        msg += ']'
-        print(msg)
-        self.__led_states = [self.OFF] * N_LEDS
-
+        # The refresh engine shows the same LEDs many times a second
+        if self.__led_mask != self.__shown_mask:
+            self.__shown_mask = self.__led_mask
+            logger.info(LED_STATE_MESSAGES[self.__led_mask])
+        self.__led_mask = 0
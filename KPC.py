@@ -1,15 +1,36 @@
 """KPC Agent"""
-from GPIOSimulator_v5 import *
-gpio_obj = GPIOSimulator()
+from kpc_logging import get_logger
+from login_limiter import LoginLimiter
+from password_store import PasswordStore
+
+logger = get_logger('kpc')
+
+# Longest password or LED entry kept; longer entries are rejected as a whole
+MAX_ENTRY_LENGTH = 16
+
+# Longest LED duration that can be entered, in seconds
+MAX_LED_DURATION = 9999
 
 
 class KPC:
-    def __init__(self, keypad_instance, led_board_instance):
+    def __init__(self, keypad_instance, led_board_instance, password_store=None, clock=None,
+                 login_limiter=None):
         self.keypad_instance = keypad_instance
         self.led_board_instance = led_board_instance
+        # Clock for the agent's own timing, by default the one the LED board runs on
+        self.clock = led_board_instance.clock if clock is None else clock
         self.pathname = 'top_secret_password_file.txt'  # complete pathname to file holding KPC's password
-        
+        if password_store is None:
+            password_store = PasswordStore(self.pathname)
+        self.password_store = password_store  # cached hash of the KPC's password
+        self.lockout_pathname = 'login_lockout.txt'  # failed logins and lockout, kept across restarts
+        if login_limiter is None:
+            login_limiter = LoginLimiter(self.lockout_pathname, self.clock)
+        self.login_limiter = login_limiter  # throttles repeated failed logins
+
         self.override_signal = ''    # Y override signal from agent signalling password acceptance
+        self.last_signal = ''        # The signal that triggered the current action
+        self.entry_overflow = False  # True once the entry being typed got too long
         self.password_buffer = ''    # Buffer for entering password char by char
 
         self.verified_password = ''  # Entered password verified as file password
@@ -22,133 +43,126 @@ class KPC:
         self.led_duration = ''      # Light user-specified led for user-specifies # secs
 
     def wake_up_sequence(self):
-        """ Method call at the beginning triggering a keypress and light display """
-        input('--------------WAKE UP SYSTEM BY PRESSING ANY KEY----------')
+        """ Method called when the first keypress wakes the system up, triggering a light display """
+        logger.info('--------------SYSTEM WOKEN UP, ENTER PASSWORD----------')
         # Powering up light show for 3 secs
         self.flash_leds(1)
 
     def reset_password_entry(self):
         """Clear password buffer and initiate a 'power up' lighting sequence
         on the LED board"""
-        self.password_buffer = ''
+        self.clear_buffer()
         self.led_board_instance.powering_up()
 
     def clear_buffer(self):
-        """Clear password buffer without lighting leds"""
+        """Clear password buffers without lighting leds"""
         self.password_buffer = ''
+        self.new_password = ''
+        self.entry_overflow = False
+
+    def signal_stream(self):
+        """Generator that yields the agent's signals one at a time: 'override_signal'
+        if it's non-blank, else the next key of the keypad's key stream"""
+        keys = self.keypad_instance.key_stream()
+        while True:
+            if self.override_signal != '':
+                # An override signal is only delivered once
+                self.last_signal, self.override_signal = self.override_signal, ''
+
+            else:
+                self.last_signal = next(keys)
+
+            yield self.last_signal
 
-    def get_next_signal(self):
-        """Return 'override_signal' if it's non-blank, else query keypad for the next
-        pressed key"""
+    async def get_next_signal_async(self):
+        """As the signal stream, but waits for the keypad without blocking the event loop"""
 
         if self.override_signal != '':
-            return self.override_signal
+            # An override signal is only delivered once
+            self.last_signal, self.override_signal = self.override_signal, ''
 
         else:
-            return self.keypad_instance.get_next_signal()
+            self.last_signal = await self.keypad_instance.get_next_signal_async()
 
-    def read_password_file(self):
-        # Open and read file containing password
-        f = open(self.pathname, 'r')
-        official_password = f.read()
-        print('Current Official Password: ', official_password)
-        f.close()
-        return official_password
+        return self.last_signal
+
+    def append_to_entry(self, entry):
+        """Return entry with the digit just pressed appended. The entry never
+        grows past MAX_ENTRY_LENGTH; if it would, it is marked as overflowed"""
+        if len(entry) >= MAX_ENTRY_LENGTH:
+            self.entry_overflow = True
+            return entry
+        return entry + self.last_signal
 
     def verify_password(self):
         """Check entered password matches that of the password file"""
-        print('Given password for checking: ', self.password_buffer)
+        # Passwords are never logged, only their length
+        logger.debug('Checking a password of %d digits', len(self.password_buffer))
+
+        # While locked out the attempt is rejected before any hashing or lights
+        remaining = self.login_limiter.remaining()
+        if remaining:
+            logger.info('Too many failed logins. Locked for %.0f more seconds.', remaining)
+            self.override_signal = 'N'
+            self.keypad_instance.sequence_of_pressed_keys.clear()
+            self.clear_buffer()
+            return
 
-        if self.password_buffer == self.read_password_file():
+        if not self.entry_overflow and self.password_store.verify(self.password_buffer):
             self.verified_password = self.password_buffer
-            print('Verified password: ', self.verified_password)
-            print('Password verified. Login granted.')
+            logger.info('Password verified. Login granted.')
+            self.login_limiter.record_success()
             self.override_signal = 'Y'
             self.led_board_instance.correct_password()
             self.current_state = 'S-Verify'
 
         else:
-            print('Password NOT verified. Try again.')
+            logger.info('Password NOT verified. Try again.')
+            lockout = self.login_limiter.record_failure()
+            if lockout:
+                logger.info('Logins locked for %d seconds.', lockout)
             self.override_signal = 'N'
             self.led_board_instance.wrong_password()
             # Empty password buffer and keypad_pressed_sequence
-            self.keypad_instance.sequence_of_pressed_keys = []
-            self.password_buffer = ''
-            self.append_next_password_digit()
+            self.keypad_instance.sequence_of_pressed_keys.clear()
+            self.clear_buffer()
 
     def validate_passcode_change(self):
         """Check new password is legal"""
         # Legal: >= 4 in length and only consisting of numbers
-        if (len(self.new_password) >= 4) and (self.new_password.isdecimal()):
+        if (len(self.new_password) >= 4) and (self.new_password.isdecimal()) and not self.entry_overflow:
+            self.override_signal = 'Y'
             self.led_board_instance.correct_password()
             # New password has been validated and gets cached to file
             self.cache_new_password()
         else:
-            print('New password does not meet formal requirements.\n')
+            self.override_signal = 'N'
+            logger.info('New password does not meet formal requirements.')
 
     def append_next_password_digit(self):
-        """ Append password entry to password buffer """
-        print('-----------------LOGIN------------------------')
-
-        self.keypad_instance.get_next_signal()
+        """ Append the digit just pressed to the password buffer """
+        logger.debug('-----------------LOGIN------------------------')
 
-        if self.keypad_instance.sequence_of_pressed_keys[-1] == '*' or \
-                self.keypad_instance.sequence_of_pressed_keys[-1] == '#':
+        self.password_buffer = self.append_to_entry(self.password_buffer)
 
-            print('Keypress: * or # ')
-
-            self.verify_password()
-
-        else:
-            self.password_buffer += (self.keypad_instance.sequence_of_pressed_keys[-1])
-
-            print('Password_buffer: ', self.password_buffer)
-            print('Sequence of pressed keys 2: ', self.keypad_instance.sequence_of_pressed_keys)
-
-            self.append_next_password_digit()
+        logger.debug('Password entry: %d digits', len(self.password_buffer))
 
     def cache_new_password(self):
         """Save the new password in a file - New password replaces old password"""
-
-        # Erase current file content (old password)
-        f = open(self.pathname, 'r+')   # r+ opens file for read and write
-        f.truncate()                    # truncate deletes file content - evt: truncate(0)
-
-        # Write/save new password in file
-        f.write(self.new_password)
-        f.close()
+        self.password_store.set_password(self.new_password)
 
     def change_password(self):
-        print('-------------CHANGE PASSWORD---------------------')
-        self.keypad_instance.get_next_signal()
-
-        if self.keypad_instance.sequence_of_pressed_keys[-1] == '*' or \
-                self.keypad_instance.sequence_of_pressed_keys[-1] == '#':
-
-            # Done making new password -  cache it to file
-            self.validate_passcode_change()
-
-        else:
-            # Change existing password
-            self.new_password += (self.keypad_instance.sequence_of_pressed_keys[-1])
+        """ Append the digit just pressed to the new password """
+        logger.debug('-------------CHANGE PASSWORD---------------------')
 
-            print('New password: ', self.new_password)
+        self.new_password = self.append_to_entry(self.new_password)
 
-            self.change_password()
+        logger.debug('New password entry: %d digits', len(self.new_password))
 
     def logout_logic(self):
-        # Logout sequence with extra check
-        print('------------------LOGOUT-----------------------------')
-        self.keypad_instance.get_next_signal()
-
-        if self.keypad_instance.sequence_of_pressed_keys[-1] == '#':
-            input_value = input('Logout initiated. Confirm logout [y/n]')
-
-            if input_value == 'y':
-                self.exit_action()
-
-            else:
-                self.clear_buffer()
+        """ Logout confirmed by a second '#', the FSM then powers down """
+        logger.info('------------------LOGOUT-----------------------------')
+        self.clear_buffer()
 
     def reset_agent(self):
         """ Putting the agent in a restricted mode where it
@@ -161,7 +175,7 @@ class KPC:
         self.led_board_instance.twinkle_all_leds(1)
         self.clear_buffer()
 
-        print('Agent fully active!')
+        logger.info('Agent fully active!')
 
     def refresh_agent(self, state):
         """ Putting the agent to a less-restricted active state from
@@ -171,35 +185,34 @@ class KPC:
         self.current_state = state
 
     def set_led_id(self):
-        print('GIVE LED_ID: ')
+        """ Use the digit just pressed as the LED id """
+        self.led_id = int(self.last_signal)
+        self.led_duration = 0
 
-        self.keypad_instance.get_next_signal()
-        self.led_id = int(self.keypad_instance.sequence_of_pressed_keys[-1])
-
-        print('Given L_id: ', self.led_id)
+        logger.debug('Given L_id: %s', self.led_id)
 
     def set_led_duration(self):
-        print('GIVE LDUR: ')
-
-        self.keypad_instance.get_next_signal()
-        self.led_duration = int(self.keypad_instance.sequence_of_pressed_keys[-1])
+        """ Append the digit just pressed to the LED duration, so durations
+        can have several digits """
+        self.led_duration = min(self.led_duration * 10 + int(self.last_signal), MAX_LED_DURATION)
 
-        print('Given Ldur: ', self.led_duration)
+        logger.debug('Given Ldur: %s', self.led_duration)
 
     # LED methods
     def light_one_led(self):
-        """Call the LED board and request LED #Lid be turned on for Ldur secs"""
-        print('------------LIGHT USER DEFINED LED FOR USER DEFINED TIME------------------')
-        self.led_board_instance.turn_on_user_specified_led(self.led_id, self.led_duration)
+        """Call the LED board and request LED #Lid be turned on for Ldur secs,
+        next to any LEDs still lit by earlier requests"""
+        logger.info('------------LIGHT USER DEFINED LED FOR USER DEFINED TIME------------------')
+        self.led_board_instance.light_led_for(self.led_id, self.led_duration)
 
     def flash_leds(self, k_sec):
         """Call LED board and request flashing of all LEDs"""
-        self.led_board_instance.flash_all_leds(k_sec)
+        return self.led_board_instance.flash_all_leds(k_sec)
 
     def twinkle_leds(self, k_sec):
         """Call LED board and request twinkling of all LEDs"""
-        self.led_board_instance.twinkle_all_leds(k_sec)
+        return self.led_board_instance.twinkle_all_leds(k_sec)
 
     def exit_action(self):
         """Call LED board to initiate 'power down' lighting sequence"""
-        self.led_board_instance.powering_down()
+        return self.led_board_instance.powering_down()
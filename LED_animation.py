@@ -0,0 +1,168 @@
+""" Background scheduler that plays LED animations without blocking the caller """
+import asyncio
+import bisect
+import heapq
+import itertools
+import threading
+from clock import REAL_CLOCK
+from GPIOSimulator_v5 import set_ready
+
+
+class Animation:
+    """ An LED animation compiled once into immutable frames. For each frame
+    it holds the LED (None for all off), the LED's (out_mask, high_mask) pin
+    configuration and the frame's start as an offset from the animation's start """
+
+    __slots__ = ('leds', 'masks', 'offsets', 'duration')
+
+    def __init__(self, frames, pin_masks):
+        """ Constructor. frames is a list of (LED, seconds) pairs, where
+        seconds is how long the frame is held, and pin_masks maps each LED
+        to its (out_mask, high_mask) """
+        offsets = []
+        offset = 0.0
+        for _, seconds in frames:
+            offsets.append(offset)
+            offset += seconds
+        self.leds = tuple(led for led, _ in frames)
+        self.masks = tuple(None if led is None else pin_masks[led] for led, _ in frames)
+        self.offsets = tuple(offsets)
+        self.duration = offset
+
+    def __len__(self):
+        return len(self.leds)
+
+
+class AnimationHandle:
+    """ Handle to an LED animation scheduled on an LEDAnimator.
+    Coroutines can await the handle to wait for the animation """
+
+    def __init__(self, animator, board, animation, start):
+        """ Constructor. animation is the compiled Animation played from time start """
+        self.animator = animator
+        self.board = board
+        self.animation = animation
+        self.start = start
+        self.index = 0              # Index of the next frame to show
+        self.cancelled = False
+        self.finished = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []       # Called once the animation is done
+
+    def cancel(self):
+        """ Stop the animation; no more frames are shown after this returns """
+        self.animator.cancel(self)
+
+    def done(self):
+        """ Return True if the animation has finished or was cancelled """
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the animation is done, return False on timeout """
+        return self.finished.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """ Call callback() from the animator thread once the animation is done,
+        or right away if it already is """
+        with self.__lock:
+            if not self.finished.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback()
+
+    def finish(self):
+        """ Mark the animation as done and run the done callbacks """
+        with self.__lock:
+            self.finished.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback()
+
+    async def wait_async(self):
+        """ Wait for the animation to be done without blocking the event loop """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.add_done_callback(lambda: loop.call_soon_threadsafe(set_ready, future))
+        await future
+
+    def __await__(self):
+        return self.wait_async().__await__()
+
+
+class LEDAnimator:
+    """ Plays LED frame sequences for any number of LED boards
+    on one background thread, ordered by a heap of frame deadlines.
+    The thread runs while there are animations and exits when idle """
+
+    def __init__(self, clock=REAL_CLOCK):
+        """ Constructor """
+        self.clock = clock
+        self.__heap = []                        # (deadline, tie breaker, handle)
+        self.__counter = itertools.count()
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def play(self, board, animation):
+        """ Schedule an Animation on board, starting now, and return a handle """
+        handle = AnimationHandle(self, board, animation, self.clock.now())
+        with self.__condition:
+            self.__push(handle.start, handle)
+            if self.__thread is None:
+                self.clock.attach()
+                self.__thread = threading.Thread(target=self.__run, name='LEDAnimator', daemon=True)
+                self.__thread.start()
+            self.clock.notify(self.__condition)
+        return handle
+
+    def cancel(self, handle):
+        """ Cancel a scheduled animation. Its heap entry is dropped lazily """
+        with self.__condition:
+            handle.cancelled = True
+            handle.finish()
+
+    def __push(self, deadline, handle):
+        """ internal function, add the next step of an animation to the heap """
+        heapq.heappush(self.__heap, (deadline, next(self.__counter), handle))
+
+    def __run(self):
+        """ internal function, the animator thread: sleep until the earliest
+        deadline, show that frame and schedule the animation's next frame.
+        Deadlines are absolute, start plus the frame's offset, so time spent
+        showing frames never adds up as drift. A late animation skips to the
+        frame due now instead of showing the missed ones """
+        with self.__condition:
+            while self.__heap:
+                deadline, _, handle = self.__heap[0]
+                if handle.cancelled:
+                    heapq.heappop(self.__heap)
+                    continue
+
+                delay = deadline - self.clock.now()
+                if delay > 0:
+                    # A new animation may arrive before the deadline and wake us up
+                    self.clock.wait(self.__condition, delay)
+                    continue
+
+                heapq.heappop(self.__heap)
+
+                animation = handle.animation
+                # All frames shown and the last one held long enough
+                if handle.index == len(animation):
+                    handle.finish()
+                    continue
+
+                index = max(handle.index,
+                            bisect.bisect_right(animation.offsets, self.clock.now() - handle.start) - 1)
+                handle.index = index + 1
+                handle.board.show_masks(animation.masks[index])
+                if handle.index < len(animation):
+                    self.__push(handle.start + animation.offsets[handle.index], handle)
+                else:
+                    self.__push(handle.start + animation.duration, handle)
+
+            self.__thread = None
+            self.clock.detach()
+
+
+# One animator is shared by every real-time LED board in the process
+ANIMATOR = LEDAnimator()
@@ -1,13 +1,55 @@
-import time
-from GPIOSimulator_v5 import GPIOSimulator
+import threading
+
+from GPIOSimulator_v5 import GPIOSimulator, charlieplexing_pins
+from LED_animation import ANIMATOR, Animation, LEDAnimator
+from clock import REAL_CLOCK
+from kpc_logging import get_logger
+from led_jobs import LEDJobScheduler
+from led_refresh import RefreshEngine
+
+logger = get_logger('led_board')
+
+
+def pin_masks(pin_settings):
+    """ Pack the pin settings of one LED into the (out_mask, high_mask)
+    pair taken by GPIOSimulator.setup_charlieplexing """
+    out_mask = high_mask = 0
+    for index, state in enumerate(pin_settings):
+        if state is not None:
+            out_mask |= 1 << index
+        if state == 1:
+            high_mask |= 1 << index
+    return out_mask, high_mask
+
+
+def cycle_frames(k, frame_time=0.5):
+    """ Frames lighting the six LEDs in turn, frame_time seconds each,
+    for exactly k seconds and then turning them off """
+    frames = []
+    elapsed = 0.0
+    while elapsed < k:
+        seconds = min(frame_time, k - elapsed)
+        frames.append((len(frames) % 6, seconds))
+        elapsed += seconds
+    frames.append((None, 0))
+    return frames
 
 
 class LEDBoard:
-    """ Class for the LED Board"""
-
-    def __init__(self):
-        """ Constructor """
-        self.GPIO = GPIOSimulator()
+    """ Class for the LED Board. The light sequences run in the background
+    and return an AnimationHandle that can be waited on or cancelled.
+    Timed LED jobs keep any number of LEDs lit at once, and give the LEDs
+    back to the animations while one plays """
+
+    def __init__(self, gpio=None, clock=REAL_CLOCK, animator=None, tracer=None):
+        """ Constructor. gpio is the simulator the LEDs are wired to, a new one by default.
+        Boards on the same simulated clock can share an animator. tracer is an
+        optional tracing.Tracer told how long each animation ran """
+        self.GPIO = GPIOSimulator() if gpio is None else gpio
+        self.clock = clock
+        if animator is None:
+            animator = ANIMATOR if clock is REAL_CLOCK else LEDAnimator(clock)
+        self.animator = animator
         self.pin_settings_pr_led = {
             0: [1, 0, None],
             1: [0, 1, None],
@@ -16,118 +58,178 @@ class LEDBoard:
             4: [1, None, 0],
             5: [0, None, 1],
         }
+        # The same settings packed once, so lighting a LED is a single GPIO call
+        self.pin_masks_pr_led = {led: pin_masks(settings)
+                                 for led, settings in self.pin_settings_pr_led.items()}
+        # Handle of the animation currently playing on this board
+        self.animation = None
+        # Animations compiled so far, by what they show
+        self.animation_cache = {}
+        self.tracer = tracer
+
+        # Timed LED jobs, and the bitmap of the LEDs they keep lit
+        self.jobs = LEDJobScheduler(self, clock)
+        self.pattern = 0
+        # Multiplexes several lit LEDs; refreshing is about the eye, so it runs in real time
+        self.refresh_engine = RefreshEngine(self, clock=REAL_CLOCK)
+        self.__lock = threading.RLock()
 
     def light_led(self, LED):
         """ Method that turns a LED on """
-        pin_settings = self.pin_settings_pr_led[LED]
-
-        # Iterating through the pin settings for specified LED
-        for index, state in enumerate(pin_settings):
+        out_mask, high_mask = self.pin_masks_pr_led[LED]
 
-            # Pin setting is output and HIGH
-            if state == 1:
-                self.GPIO.setup(index, self.GPIO.OUT)
-                self.GPIO.output(index, self.GPIO.HIGH)
+        # Setting the modes and states of all three charlieplexing pins at once
+        self.GPIO.setup_charlieplexing(out_mask, high_mask)
 
-            # Pin setting is output and LOW
-            elif state == 0:
-                self.GPIO.setup(index, self.GPIO.OUT)
-                self.GPIO.output(index, self.GPIO.LOW)
+        # Printing the current state of all LEDs
+        self.GPIO.show_leds_states()
 
-            # Pin setting is input
-            elif state is None:
-                self.GPIO.setup(index, self.GPIO.IN)
+    def turn_off_leds(self):
+        """ Method that turns all LEDs off """
+        # Only the LED pins, the keypad may share the simulator
+        self.GPIO.cleanup(charlieplexing_pins)
 
-        # Printing the current state of all LEDs
         self.GPIO.show_leds_states()
 
+    def show_frame(self, LED):
+        """ Method that shows one animation frame, where None means all LEDs off """
+        if LED is None:
+            self.turn_off_leds()
+        else:
+            self.light_led(LED)
+
+    def show_masks(self, masks):
+        """ Method that shows a precompiled frame: the (out_mask, high_mask)
+        pin configuration of an LED, or None for all LEDs off """
+        if masks is None:
+            self.turn_off_leds()
+        else:
+            self.GPIO.setup_charlieplexing(*masks)
+            self.GPIO.show_leds_states()
+
+    def compile_animation(self, frames):
+        """ Method that compiles a list of (LED, seconds) frames into an Animation """
+        return Animation(frames, self.pin_masks_pr_led)
+
+    def compiled(self, key, frames):
+        """ Method that returns the animation compiled for key, compiling
+        frames() the first time it is asked for """
+        animation = self.animation_cache.get(key)
+        if animation is None:
+            animation = self.animation_cache[key] = self.compile_animation(frames())
+        return animation
+
+    def play(self, animation, name='animation'):
+        """ Method that starts an animation in the background and returns its handle.
+        animation is an Animation or a list of (LED, seconds) frames to compile.
+        Any animation still running on this board is pre-empted """
+        if not isinstance(animation, Animation):
+            animation = self.compile_animation(animation)
+        self.cancel_animation()
+        with self.__lock:
+            # The animation has the LEDs to itself until it is done
+            self.refresh_engine.stop()
+        handle = self.animation = self.animator.play(self, animation)
+        handle.add_done_callback(lambda: self.animation_done(handle))
+        if self.tracer is not None:
+            start = self.clock.now()
+            handle.add_done_callback(lambda: self.tracer.animation(name, self.clock.now() - start))
+        return handle
+
+    def cancel_animation(self):
+        """ Method that cancels the current animation, if any, leaving the LEDs as they are """
+        animation, self.animation = self.animation, None
+        if animation is not None:
+            animation.cancel()
+
+    def stop_animation(self):
+        """ Method that cancels the current animation, if any,
+        and shows the LEDs lit by jobs again """
+        self.cancel_animation()
+        self.show_pattern(self.pattern)
+
+    def animation_done(self, handle):
+        """ Method called when an animation ends; unless another one replaced
+        it, the LEDs lit by jobs are shown again """
+        with self.__lock:
+            if self.animation is handle:
+                self.animation = None
+                self.show_pattern(self.pattern)
+
+    def show_pattern(self, pattern):
+        """ Method that keeps the LEDs in bitmap pattern lit, a single LED
+        directly and several through the refresh engine. While an animation
+        plays the pattern is only remembered """
+        with self.__lock:
+            changed = pattern != self.pattern
+            self.pattern = pattern
+            if self.animation is not None and not self.animation.done():
+                return
+
+            leds = [led for led in range(len(self.pin_masks_pr_led)) if pattern >> led & 1]
+            if len(leds) > 1:
+                self.refresh_engine.set_pattern(pattern)
+                self.refresh_engine.start()
+                return
+
+            self.refresh_engine.stop()
+            if leds:
+                self.light_led(leds[0])
+            elif changed:
+                self.turn_off_leds()
+
+    def light_led_for(self, LED, seconds):
+        """ Method that lights one LED for seconds, next to any other LEDs lit this way """
+        if self.tracer is not None:
+            self.tracer.led_job(LED, seconds)
+        self.jobs.add(LED, seconds)
+
     def turn_on_user_specified_led(self, LED, k):
         """ Method that turns one user-specified LED on
         for a user-specified number of seconds, where information
         about the particular LED and duration are entered
         via the simulated keypad """
 
-        self.light_led(LED)
-
-        time.sleep(k)
-
-        self.GPIO.cleanup()
-
-        self.GPIO.show_leds_states()
+        return self.play(self.compiled(('led', LED, k), lambda: [(LED, k), (None, 0)]), 'led')
 
     def flash_all_leds(self, k):
         """ Method that makes one LEDs flash at a time for k seconds """
 
-        reference_time = time.time()
-        duration_time = reference_time + k
-        is_time_over = False
-
-        # Making it possible to light the same LED again
-        while not is_time_over:
-
-            for pin in range(6):
-
-                self.light_led(pin)
-
-                # Checking if k seconds is passed
-                time_now = time.time()
-                if time_now > duration_time:
-                    is_time_over = True
-                    break
-
-                # Making the iteration go a bit slower
-                time.sleep(0.5)
+        # One LED every half second, wrapping around to light the same LED again
+        return self.play(self.compiled(('flash', k), lambda: cycle_frames(k)), 'flash')
 
     def twinkle_all_leds(self, k):
         """ Method that turns all LEDS on and off in sequence for k seconds """
 
-        reference_time = time.time()
-        duration_time = reference_time + k
-        is_time_over = False
-
-        # Making it possible to light the sequence of LEDs again
-        while not is_time_over:
-
-            for pin in range(6):
-
-                self.light_led(pin)
-
-                # Making the iteration go a bit slower
-                time.sleep(0.5)
-
-            time_now = time.time()
-            if time_now > duration_time:
-                is_time_over = True
+        # The six LEDs in turn, stopping after exactly k seconds
+        return self.play(self.compiled(('twinkle', k), lambda: cycle_frames(k)), 'twinkle')
 
     def powering_up(self):
         """ Method that displays light that indicates that
         the system is powering up """
-        print("---------Powering up LED sequence!---------------")
+        logger.info("---------Powering up LED sequence!---------------")
 
-        # Turning on LED 0 for 6 sec
-        self.turn_on_user_specified_led(0, 2)
+        # Turning on LED 0 for 2 sec
+        return self.turn_on_user_specified_led(0, 2)
 
     def powering_down(self):
         """ Method that displays light that indicates that
         the system is powering down """
 
-        print("----------Powering down LED sequence..------------")
+        logger.info("----------Powering down LED sequence..------------")
 
         # Making LED 4 and 5 twinkle a couple of times
-        for i in range(4):
-            self.turn_on_user_specified_led(4, 2)
-            time.sleep(1.0)
-            self.turn_on_user_specified_led(5, 2)
-            time.sleep(1.0)
+        return self.play(self.compiled('powering_down', lambda: [(4, 2), (None, 1.0), (5, 2), (None, 1.0)] * 4),
+                         'powering_down')
 
     def wrong_password(self):
         """ Method that flashes lights “in synchrony” when
         the user enters the wrong password during login """
 
-        print("-----------Wrong password LED sequence--------------")
-        self.flash_all_leds(5.5)
+        logger.info("-----------Wrong password LED sequence--------------")
+        return self.flash_all_leds(5.5)
 
     def correct_password(self):
         """ Method that twinkles the lights when the user successfully logs in """
-        print("-----------Correct password LED sequence-------------")
-        self.twinkle_all_leds(2)
+        logger.info("-----------Correct password LED sequence-------------")
+        return self.twinkle_all_leds(2)
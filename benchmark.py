@@ -0,0 +1,352 @@
+""" Micro-benchmarks for the simulated hardware paths and the password file """
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+import timeit
+from GPIOSimulator_v5 import GPIOSimulator, keypad_row_pins, keypad_col_pins, N_LEDS
+from journal import Journal, JournalReader, TRANSITION
+from checkpoint import Checkpointer
+from keypad import Keypad
+from kpc_logging import setup_logging, stop_logging
+from LED_board import LEDBoard, cycle_frames
+from led_refresh import RefreshEngine
+from password_store import PasswordStore
+from clock import SimulatedClock
+
+
+def light_led_per_pin(gpio, pin_settings):
+    """ The old LEDBoard.light_led: one setup and output call per pin """
+    for index, state in enumerate(pin_settings):
+        if state == 1:
+            gpio.setup(index, gpio.OUT)
+            gpio.output(index, gpio.HIGH)
+        elif state == 0:
+            gpio.setup(index, gpio.OUT)
+            gpio.output(index, gpio.LOW)
+        elif state is None:
+            gpio.setup(index, gpio.IN)
+
+
+def bench_light_led(number=20000):
+    """ Compare lighting all six LEDs pin by pin against one bulk call per LED """
+    board = LEDBoard(GPIOSimulator(headless=True))
+    gpio = board.GPIO
+    settings = [board.pin_settings_pr_led[led] for led in range(6)]
+    masks = [board.pin_masks_pr_led[led] for led in range(6)]
+
+    def per_pin():
+        for pin_settings in settings:
+            light_led_per_pin(gpio, pin_settings)
+
+    def bulk():
+        for out_mask, high_mask in masks:
+            gpio.setup_charlieplexing(out_mask, high_mask)
+
+    per_pin_time = min(timeit.repeat(per_pin, number=number, repeat=3))
+    bulk_time = min(timeit.repeat(bulk, number=number, repeat=3))
+    frames = number * 6
+    print('light_led per pin: %.2f us/frame' % (per_pin_time / frames * 1e6))
+    print('light_led bulk:    %.2f us/frame' % (bulk_time / frames * 1e6))
+    print('speedup:           %.1fx' % (per_pin_time / bulk_time))
+
+
+def poll_pin_by_pin(gpio):
+    """ The old Keypad.do_polling: drive each row HIGH and read each column """
+    for row in keypad_row_pins:
+        gpio.output(row, gpio.HIGH)
+        for col in keypad_col_pins:
+            if gpio.input(col) == gpio.HIGH:
+                return row, col
+        gpio.output(row, gpio.LOW)
+    return None
+
+
+def bench_scan_matrix(number=20000):
+    """ Compare one idle keypad scan pin by pin against one scan_matrix call """
+    keypad = Keypad(GPIOSimulator(headless=True))
+    keypad.setup()
+
+    per_pin_time = min(timeit.repeat(lambda: poll_pin_by_pin(keypad.GPIO), number=number, repeat=3))
+    scan_time = min(timeit.repeat(keypad.scan_matrix, number=number, repeat=3))
+    print('keypad scan per pin:  %.2f us/scan' % (per_pin_time / number * 1e6))
+    print('keypad scan_matrix:   %.2f us/scan' % (scan_time / number * 1e6))
+    print('speedup:              %.1fx' % (per_pin_time / scan_time))
+
+
+def bench_password_writes(n_threads=8, changes_per_thread=50):
+    """ Measure set_password latency while many threads change the password,
+    and how many atomic writes (each one fsync of the file) that costs """
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'password.txt')
+        with open(pathname, 'w') as password_file:
+            password_file.write('1234')
+        # A low iteration count keeps hashing from hiding the file I/O
+        store = PasswordStore(pathname, iterations=1000)
+        store.verify('1234')
+        store.write_count = 0
+
+        latencies = []
+
+        def change_passwords(thread_index):
+            for change in range(changes_per_thread):
+                start = time.perf_counter()
+                store.set_password('%d%04d' % (thread_index, change))
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=change_passwords, args=(i,)) for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store.flush()
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    changes = len(latencies)
+    print('password changes:     %d from %d threads in %.3f s' % (changes, n_threads, elapsed))
+    print('set_password latency: p50 %.3f ms, p99 %.3f ms' %
+          (latencies[changes // 2] * 1e3, latencies[int(changes * 0.99)] * 1e3))
+    print('atomic file writes:   %d' % store.write_count)
+
+
+def show_leds_states_print(led_mask, stream):
+    """ The old GPIOSimulator.show_leds_states: concatenate the message and print it """
+    state_strs = ['OFF', 'ON ']
+    msg = 'LEDs['
+    for i in range(N_LEDS):
+        comma = '' if i == 0 else ','
+        msg += "%s  %d: %s" % (comma, i, state_strs[led_mask >> i & 1])
+    msg += ']'
+    print(msg, file=stream, flush=True)
+
+
+class SlowStream:
+    """ Output stream that takes delay seconds per write, like a busy terminal """
+
+    def __init__(self, delay=0.0001):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def bench_show_leds_states(number=2000):
+    """ Compare the caller's cost of showing the LED states with print against
+    queued logging, both writing to a slow stream, and logging below its level """
+    board = LEDBoard(GPIOSimulator(headless=True))
+    gpio = board.GPIO
+    stream = SlowStream()
+    print_time = min(timeit.repeat(lambda: show_leds_states_print(5, stream), number=number, repeat=3))
+
+    # Alternating LEDs, as only a change of the LED states is logged
+    frames = itertools.cycle((board.pin_masks_pr_led[0], board.pin_masks_pr_led[2]))
+
+    def show_next():
+        gpio.setup_charlieplexing(*next(frames))
+        gpio.show_leds_states()
+
+    handler = logging.StreamHandler(stream)
+    setup_logging(logging.INFO, handler)
+    logging_time = min(timeit.repeat(show_next, number=number, repeat=3))
+    stop_logging()
+
+    setup_logging(logging.WARNING, handler)
+    disabled_time = min(timeit.repeat(show_next, number=number, repeat=3))
+    stop_logging()
+
+    print('show_leds_states print:    %.2f us/call' % (print_time / number * 1e6))
+    print('show_leds_states logging:  %.2f us/call' % (logging_time / number * 1e6))
+    print('show_leds_states disabled: %.2f us/call' % (disabled_time / number * 1e6))
+
+
+def typing_events(presses=200, hold=0.03, long_hold=1.0, gap=0.3):
+    """ A scripted typist: (time, key, pressed) edges of short presses,
+    with every tenth key held down for long_hold seconds """
+    events = []
+    now = 0.0
+    for index in range(presses):
+        key = '0123456789'[index % 10]
+        duration = long_hold if index % 10 == 9 else hold
+        events += [(now, key, True), (now + duration, key, False)]
+        now += duration + gap
+    return events
+
+
+def run_typist(keypad, events, read):
+    """ Replay typist edges on the keypad's simulator while read(keypad, until)
+    collects keys, return the keys read """
+    gpio = keypad.GPIO
+    clock = keypad.clock
+    keys = []
+    for at, key, pressed in events:
+        keys += read(keypad, at)
+        (gpio.press_key if pressed else gpio.release_key)(key)
+    keys += read(keypad, clock.now() + 1)
+    return keys
+
+
+def read_old_polling(keypad, until):
+    """ The old polling loop: register whatever key is down, then sleep 0.12 s """
+    keys = []
+    while keypad.clock.now() < until:
+        key = keypad.do_polling()
+        if key is not None:
+            keys.append(key)
+        keypad.clock.sleep(0.12)
+    return keys
+
+
+def read_debounced(keypad, until):
+    """ Keypad.get_next_signal with the debouncer, until the simulated time until """
+    keys = []
+    while keypad.clock.now() < until:
+        key = keypad.get_next_signal(until - keypad.clock.now())
+        if key is not None:
+            keys.append(key)
+    return keys
+
+
+def bench_debounce(presses=200):
+    """ Count the keys the polling keypad reports for a typist's presses,
+    with the old poll loop and with debouncing """
+    events = typing_events(presses)
+    for name, read in (('old polling', read_old_polling), ('debounced', read_debounced)):
+        keypad = Keypad(GPIOSimulator(headless=True), event_driven=False, clock=SimulatedClock())
+        keypad.setup()
+        keys = run_typist(keypad, events, read)
+        # Consecutive presses are of different keys, so a run of one key is one press
+        runs = sum(1 for index, key in enumerate(keys) if index == 0 or keys[index - 1] != key)
+        print('%-11s %4d presses -> %4d keys: %3d missed, %3d phantom repeats' %
+              (name, presses, len(keys), presses - runs, len(keys) - runs))
+
+
+def bench_refresh(slots=200000, pattern=0b100101, brightness=None):
+    """ Measure one persistence-of-vision refresh slot, and check the duty
+    cycles against the LED the simulator lights in each slot """
+    brightness = {2: 0.5} if brightness is None else brightness
+    board = LEDBoard(GPIOSimulator(headless=True))
+    engine = RefreshEngine(board)
+    engine.set_pattern(pattern, brightness)
+    slot_time = min(timeit.repeat(lambda: engine.refresh(slots), number=1, repeat=3)) / slots
+
+    lit = [0] * 6
+    samples = engine.levels * 6 * 100
+    for _ in range(samples):
+        engine.refresh()
+        led = board.GPIO.lit_led()
+        if led >= 0:
+            lit[led] += 1
+
+    print('refresh slot:         %.2f us, up to %.0f kHz' % (slot_time * 1e6, 1e-3 / slot_time))
+    print('duty cycles:          %s (brightness %s)' %
+          (' '.join('%d:%.3f' % (led, lit[led] / samples) for led in range(6)), engine.brightness))
+
+
+def bench_journal(records=1000000):
+    """ Measure appending records to a journal and scanning them through
+    its memory map, against writing and parsing a line of text per event """
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'journal.bin')
+        text_pathname = os.path.join(directory, 'journal.txt')
+        signals = [key.encode() for key in '0123456789*#']
+
+        journal = Journal(pathname, SimulatedClock())
+        start = time.perf_counter()
+        for index in range(records):
+            journal.append(index & 0xff, TRANSITION, index % 9, (index + 1) % 9, signals[index % 12], 1e-5)
+        journal.close()
+        append_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(text_pathname, 'w') as text_file:
+            for index in range(records):
+                text_file.write('%r %d transition %d %d %s %r\n' % (0.0, index & 0xff, index % 9, (index + 1) % 9,
+                                                                    signals[index % 12].decode(), 1e-5))
+        text_time = time.perf_counter() - start
+
+        # Post-mortem question: how often was each state entered?
+        start = time.perf_counter()
+        entered = [0] * 256
+        with JournalReader(pathname) as reader:
+            for _, _, kind, _, target, _, _ in reader:
+                if kind == TRANSITION:
+                    entered[target] += 1
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        text_entered = [0] * 256
+        with open(text_pathname) as text_file:
+            for line in text_file:
+                fields = line.split()
+                if fields[2] == 'transition':
+                    text_entered[int(fields[4])] += 1
+        parse_time = time.perf_counter() - start
+        sizes = os.path.getsize(pathname), os.path.getsize(text_pathname)
+
+    assert entered == text_entered
+    print('journal append:       %.2f us/record (text lines %.2f us)' %
+          (append_time / records * 1e6, text_time / records * 1e6))
+    print('journal scan:         %.1f M records/s (parsing text %.1f M lines/s)' %
+          (records / scan_time / 1e6, records / parse_time / 1e6))
+    print('journal size:         %.1f MB (text %.1f MB)' % (sizes[0] / 1e6, sizes[1] / 1e6))
+
+
+def bench_checkpoint(number=10000):
+    """ Measure saving a checkpoint after a transition, and resuming a
+    logged-in device with an LED lit against booting and logging in again """
+    # Imported here, as device_pool imports most of the system
+    from device_pool import Device, LOGIN, PASSWORD
+    # Light LED 3 for 60 seconds, so it is still lit at the restart
+    trace = LOGIN + [(2.0, '3'), (0.6, '6'), (0.3, '0'), (0.5, '*')]
+
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'password.txt')
+        with open(pathname, 'w') as password_file:
+            password_file.write(PASSWORD)
+        password_store = PasswordStore(pathname, iterations=1000)
+        checkpoint_pathname = os.path.join(directory, 'checkpoint.txt')
+
+        clock = SimulatedClock()
+        device = Device(password_store, clock)
+        checkpointer = device.fsm.checkpointer = Checkpointer(checkpoint_pathname, device.fsm)
+        device.replay(trace)
+        checkpointer.flush()
+        writes = checkpointer.write_count
+        # State unchanged since the last transition: only the snapshot is taken
+        save_time = min(timeit.repeat(checkpointer.save, number=number, repeat=3)) / number
+        device.shutdown()
+
+        restarted = Device(password_store, clock)
+        checkpointer = restarted.fsm.checkpointer = Checkpointer(checkpoint_pathname, restarted.fsm)
+        start = time.perf_counter()
+        resumed = checkpointer.restore()
+        restore_time = time.perf_counter() - start
+        state, lit = restarted.fsm.current_state, restarted.led_board.jobs.lit_until()
+        # What the first key of a fresh start shows before the password can be typed
+        wake_up = restarted.led_board.compiled(('flash', 1), lambda: cycle_frames(1)).duration
+        restarted.shutdown()
+        password_store.flush()
+
+    print('checkpoint save:      %.1f us per transition, %d writes for %d keys' %
+          (save_time * 1e6, writes, len(trace)))
+    print('checkpoint restore:   %.2f ms to %s in %s with LEDs %s lit; a fresh start shows a %.1f s '
+          'wake-up flash and asks for the password again' %
+          (restore_time * 1e3, 'resume' if resumed else 'fail to resume', state, sorted(lit), wake_up))
+
+
+if __name__ == '__main__':
+    bench_light_led()
+    bench_scan_matrix()
+    bench_password_writes()
+    bench_show_leds_states()
+    bench_debounce()
+    bench_refresh()
+    bench_journal()
+    bench_checkpoint()
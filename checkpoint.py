@@ -0,0 +1,128 @@
+""" Checkpoints of a running KPC, so a restarted device carries on where it
+stopped: the FSM state, the KPC's LED entry and the LEDs lit by jobs are
+snapshotted to a small file, and restored instead of booting afresh """
+import json
+import os
+
+from FSM_rules import ENTRY_STATES
+from kpc_logging import get_logger
+from password_store import CoalescingWriter, write_atomic
+
+logger = get_logger('checkpoint')
+
+VERSION = 1
+CHECKPOINT_INTERVAL = 0.5   # Seconds a snapshot waits for further changes to coalesce with
+MAX_CHECKPOINT_AGE = 300    # Seconds without changes after which a checkpoint is too old to resume from
+FLUSH_TIMEOUT = 5.0         # Seconds clear waits for a checkpoint being written
+
+# The KPC fields a checkpoint keeps. Passwords being typed are never written
+# to disk, nor is the last key, which may be a password digit
+AGENT_FIELDS = ('override_signal', 'led_id', 'led_duration')
+
+
+class Checkpointer:
+    """ Class that checkpoints an FSM, its KPC agent and the agent's LED board.
+    save is cheap enough to call after every transition: it only builds the
+    snapshot, and a background writer atomically replaces the checkpoint file
+    with the newest one, coalescing the snapshots taken within interval.
+    Times are kept as wall clock time, so LED jobs end when they would have """
+
+    def __init__(self, pathname, fsm, interval=CHECKPOINT_INTERVAL, max_age=MAX_CHECKPOINT_AGE):
+        """ Constructor """
+        self.pathname = pathname
+        self.fsm = fsm
+        self.agent = fsm.agent
+        self.board = fsm.agent.led_board_instance
+        self.clock = self.board.clock
+        self.interval = interval
+        self.max_age = max_age
+        self.write_count = 0            # Number of checkpoints written
+
+        self.__latest = None            # Latest snapshot taken, written or not
+        self.__writer = CoalescingWriter(self.__write, interval, 'CheckpointWriter')
+
+    def snapshot(self):
+        """ Return the current state as checkpoint text """
+        # The LED jobs run on the board's clock, which only tells time since it started
+        offset = self.clock.wall_time() - self.clock.now()
+        leds = sorted((led, round(until + offset, 3)) for led, until in self.board.jobs.lit_until().items())
+        fields = {name: getattr(self.agent, name) for name in AGENT_FIELDS}
+        return json.dumps([VERSION, self.fsm.current_state, fields, leds], separators=(',', ':'))
+
+    def save(self):
+        """ Snapshot the current state; the checkpoint file is replaced in the background """
+        snapshot = self.snapshot()
+        # Only the FSM's thread saves, so the latest snapshot needs no lock
+        if snapshot != self.__latest:
+            self.__latest = snapshot
+            self.__writer.submit(snapshot)
+
+    def __write(self, snapshot):
+        """ internal function, the background write of a snapshot """
+        # The time of writing, not of the snapshot, tells how old the checkpoint is
+        write_atomic(self.pathname, '%r %s\n' % (self.clock.wall_time(), snapshot))
+        self.write_count += 1
+
+    def flush(self, timeout=None):
+        """ Wait until the latest snapshot is written, return False on timeout.
+        Raises the OSError of a write that failed """
+        return self.__writer.flush(timeout)
+
+    def clear(self, timeout=FLUSH_TIMEOUT):
+        """ Remove the checkpoint, e.g. after logging out, so the next start boots afresh.
+        Waits at most timeout seconds for a checkpoint being written """
+        self.__writer.cancel()
+        self.__latest = None
+        try:
+            if not self.__writer.flush(timeout):
+                logger.warning('Checkpoint %s still being written, removing it anyway', self.pathname)
+        except OSError:
+            # Already logged by the writer; there is nothing left to resume from anyway
+            pass
+        try:
+            os.remove(self.pathname)
+        except FileNotFoundError:
+            pass
+
+    def restore(self):
+        """ Put the FSM, the agent and the LED jobs back as the checkpoint has
+        them; the FSM's rules must be created. Returns False, leaving everything
+        as it is, if there is no checkpoint to resume from or it is malformed or too old """
+        try:
+            with open(self.pathname, 'r') as checkpoint_file:
+                written, snapshot = checkpoint_file.read().split(' ', 1)
+            version, state, fields, leds = json.loads(snapshot)
+            written = float(written)
+        except FileNotFoundError:
+            return False
+        except (ValueError, TypeError):
+            logger.warning('Ignoring malformed checkpoint %s', self.pathname)
+            return False
+
+        # Only states the FSM can leave again are worth resuming in
+        states = {rule.state_1 for rule in self.fsm.rules}
+        if version != VERSION or set(fields) != set(AGENT_FIELDS) or state not in states:
+            logger.warning('Ignoring incompatible checkpoint %s', self.pathname)
+            return False
+        now = self.clock.wall_time()
+        # A checkpoint from the future means the wall clock was set back, so its age is unknown
+        if not 0 <= now - written <= self.max_age:
+            logger.info('Checkpoint %s is too old to resume from', self.pathname)
+            return False
+        if state == self.fsm.start_state:
+            return False
+
+        self.fsm.current_state = state
+        for name, value in fields.items():
+            setattr(self.agent, name, value)
+        if state in ENTRY_STATES:
+            # A password was being typed, and what was typed of it is not checkpointed
+            self.agent.clear_buffer()
+            logger.info('Password entry restarted, type the password again')
+        for led, until in leds:
+            if until > now:
+                self.board.light_led_for(led, until - now)
+
+        self.__latest = snapshot
+        logger.info('Resumed in state %s from checkpoint', state)
+        return True
@@ -0,0 +1,203 @@
+""" Clocks used by the LED board, keypad and KPC for all their timing.
+RealClock follows the monotonic wall clock; SimulatedClock is a
+discrete-event clock that jumps from one deadline to the next instead of
+sleeping, so long simulations run as fast as the code allows """
+import heapq
+import itertools
+import threading
+import time
+
+EVENT_POLL_INTERVAL = 0.001     # Real seconds between checks of an event waited on with a simulated timeout
+
+
+class RealClock:
+    """ Clock that runs in real time """
+
+    @staticmethod
+    def now():
+        """ Current time in seconds, from the monotonic clock """
+        return time.monotonic()
+
+    @staticmethod
+    def wall_time():
+        """ Seconds since the epoch, for times that must survive a restart """
+        return time.time()
+
+    @staticmethod
+    def sleep(seconds):
+        """ Block for seconds """
+        time.sleep(seconds)
+
+    @staticmethod
+    def wait(waitable, timeout=None):
+        """ Wait on a threading.Event, or a threading.Condition whose lock is held,
+        for at most timeout seconds. Returns what waitable.wait returns """
+        return waitable.wait(timeout)
+
+    @staticmethod
+    def attach():
+        """ A background thread that waits on the clock is about to start """
+
+    @staticmethod
+    def detach():
+        """ A thread that attached is done """
+
+    @staticmethod
+    def notify(condition):
+        """ Wake the threads waiting on condition, whose lock is held """
+        condition.notify_all()
+
+    @staticmethod
+    def receive(get, timeout=None):
+        """ Call get(timeout), a function that waits at most timeout seconds
+        for an item and returns None if none arrives, e.g. GPIOSimulator.get_key_event """
+        return get(timeout)
+
+
+class SimulatedWaiter:
+    """ A thread blocked in SimulatedClock.wait """
+
+    __slots__ = ('deadline', 'waitable', 'reached', 'woken')
+
+    def __init__(self, deadline, waitable):
+        """ Constructor """
+        self.deadline = deadline    # None if the wait has no timeout
+        self.waitable = waitable
+        self.reached = False        # Simulated time reached the deadline
+        self.woken = False          # Counted as running again by whoever woke it
+
+
+class SimulatedClock:
+    """ Discrete-event clock. Time only moves when the driving thread sleeps,
+    receives with a timeout or calls advance. The background threads that
+    wait on the clock attach to it, and block in wait until they are notified
+    or time reaches their deadline. Advancing steps from the earliest pending
+    deadline to the next, and only once every attached thread is blocked,
+    so whatever is due at one time has run before time moves on """
+
+    def __init__(self, start=0.0):
+        """ Constructor """
+        self.__now = start
+        self.__condition = threading.Condition()
+        self.__deadlines = []                   # (deadline, tie breaker, waiter) of the timed waits
+        self.__counter = itertools.count()
+        self.__blocked = {}                     # waitable -> waiters blocked on it
+        self.__running = 0                      # Attached threads not blocked in wait
+
+    def now(self):
+        """ Current simulated time in seconds """
+        return self.__now
+
+    def wall_time(self):
+        """ Simulated time is also the simulated wall clock """
+        return self.__now
+
+    def attach(self):
+        """ A background thread that waits on the clock is about to start.
+        It counts as running, holding time back, until it waits """
+        with self.__condition:
+            self.__running += 1
+
+    def detach(self):
+        """ An attached thread is done """
+        with self.__condition:
+            self.__running -= 1
+            self.__condition.notify_all()
+
+    def notify(self, condition):
+        """ As RealClock.notify; the threads woken count as running until they wait again """
+        with self.__condition:
+            self.__wake(self.__blocked.pop(condition, ()))
+        condition.notify_all()
+
+    def __wake(self, waiters):
+        """ internal function, count waiters as running, the clock's lock held """
+        for waiter in waiters:
+            if not waiter.woken:
+                waiter.woken = True
+                self.__running += 1
+
+    def advance(self, seconds):
+        """ Move simulated time forward by seconds, waking the waiters
+        whose deadlines it passes in the order of their deadlines """
+        with self.__condition:
+            target = self.__now + max(seconds, 0)
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__running <= 0)
+                waiter = self.__pop_due(target)
+                if waiter is None:
+                    self.__now = max(self.__now, target)
+                    return
+                self.__now = max(self.__now, waiter.deadline)
+                waiter.reached = True
+                if isinstance(waiter.waitable, threading.Event):
+                    # Polled, see wait
+                    self.__wake((waiter,))
+                    continue
+            with waiter.waitable:
+                self.notify(waiter.waitable)
+
+    def __pop_due(self, target):
+        """ internal function, pop the earliest waiter still blocked with
+        a deadline by target, the clock's lock held """
+        while self.__deadlines and self.__deadlines[0][0] <= target:
+            _, _, waiter = heapq.heappop(self.__deadlines)
+            if not waiter.woken:
+                return waiter
+        return None
+
+    def sleep(self, seconds):
+        """ Sleeping takes no real time, beyond that of the threads woken meanwhile """
+        self.advance(seconds)
+
+    def wait(self, waitable, timeout=None):
+        """ As RealClock.wait, for attached threads: the timeout runs out when
+        the driving thread moves simulated time past it. A condition must be
+        woken through notify, so the clock knows its waiters are running """
+        with self.__condition:
+            deadline = None if timeout is None else self.__now + timeout
+            if deadline is not None and deadline <= self.__now:
+                waiter = None
+            else:
+                waiter = SimulatedWaiter(deadline, waitable)
+                if deadline is not None:
+                    heapq.heappush(self.__deadlines, (deadline, next(self.__counter), waiter))
+                self.__blocked.setdefault(waitable, []).append(waiter)
+                self.__running -= 1
+                self.__condition.notify_all()
+        if waiter is None:
+            return waitable.wait(0)
+
+        if isinstance(waitable, threading.Event):
+            # The clock cannot wake an event, so it is polled
+            while not waitable.wait(EVENT_POLL_INTERVAL) and not waiter.reached:
+                pass
+        else:
+            waitable.wait()
+
+        with self.__condition:
+            waiters = self.__blocked.get(waitable, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.__blocked[waitable]
+            # Woken some other way, e.g. by an event being set
+            self.__wake((waiter,))
+        if isinstance(waitable, threading.Event):
+            return waitable.is_set()
+        # Woken by the clock means timed out, any other wake-up was a notification
+        return not waiter.reached
+
+    def receive(self, get, timeout=None):
+        """ As RealClock.receive, except that the timeout passes in simulated time """
+        if timeout is None:
+            return get(None)
+        item = get(0)
+        if item is None:
+            self.advance(timeout)
+        return item
+
+
+# The clock used when none is given
+REAL_CLOCK = RealClock()
@@ -0,0 +1,96 @@
+""" Debouncing and auto-repeat for the keypad. A KeyDebouncer turns samples
+of the keypad's key bitmap into key events: one per press, plus repeats
+of a key that is held down when auto-repeat is on """
+
+DEBOUNCE_TIME = 0.02    # Seconds after an accepted edge during which the key's contacts may bounce
+REPEAT_DELAY = None     # Seconds a key is held before it starts repeating, None for no auto-repeat
+REPEAT_INTERVAL = 0.1   # Seconds between repeats of a held key
+
+
+class KeyDebouncer:
+    """ Debouncing state machine for up to n_keys keys, one bit per key.
+    A press is reported at its first rising edge, after which that key's
+    edges are ignored for settle seconds, so a bouncing contact is one press.
+    A press that came and went between two samples is still reported,
+    as long as the sampler latched it """
+
+    def __init__(self, n_keys, settle=DEBOUNCE_TIME, repeat_delay=REPEAT_DELAY, repeat_interval=REPEAT_INTERVAL):
+        """ Constructor """
+        self.settle = settle
+        self.repeat_delay = repeat_delay
+        self.repeat_interval = repeat_interval
+        self.down_mask = 0                          # Keys debounced as held down
+        self.held_mask = 0                          # Keys down in the latest sample
+        self.edge_time = [float('-inf')] * n_keys   # Time of each key's latest accepted edge
+        self.next_repeat = [None] * n_keys          # When each held key repeats next
+
+    def update(self, now, held, latched=0):
+        """ Take a sample at time now: held is the bitmap of keys down now and
+        latched the keys that went down since the previous sample, even if they
+        are up again. Returns the bit indexes of the keys pressed or repeating """
+        events = []
+        self.held_mask = held
+
+        # A key that went up again is released once its press has settled
+        released = self.down_mask & ~held
+        while released:
+            bit = released & -released
+            released ^= bit
+            index = bit.bit_length() - 1
+            if now - self.edge_time[index] >= self.settle:
+                self.down_mask &= ~bit
+                self.edge_time[index] = now
+
+        # A latched key that is still down was released and pressed again in between
+        pressed = (held & ~self.down_mask) | latched
+        while pressed:
+            bit = pressed & -pressed
+            pressed ^= bit
+            index = bit.bit_length() - 1
+            if now - self.edge_time[index] < self.settle:
+                # Contact bounce
+                continue
+            events.append(index)
+            self.edge_time[index] = now
+            if held & bit:
+                self.down_mask |= bit
+                if self.repeat_delay is not None:
+                    self.next_repeat[index] = now + self.repeat_delay
+            else:
+                # Pressed and released between two samples
+                self.down_mask &= ~bit
+
+        if self.repeat_delay is not None:
+            repeating = self.down_mask & held
+            while repeating:
+                bit = repeating & -repeating
+                repeating ^= bit
+                index = bit.bit_length() - 1
+                if index not in events and now >= self.next_repeat[index]:
+                    events.append(index)
+                    self.next_repeat[index] += self.repeat_interval
+                    if self.next_repeat[index] <= now:
+                        # A late sample does not make up for the repeats it missed
+                        self.next_repeat[index] = now + self.repeat_interval
+
+        return events
+
+    def next_deadline(self):
+        """ The earliest time a sample with unchanged keys may report a key
+        or finish a release, or None if none will """
+        deadlines = []
+        # Keys whose pending press or release waits for the bounce to settle
+        unsettled = self.held_mask ^ self.down_mask
+        while unsettled:
+            bit = unsettled & -unsettled
+            unsettled ^= bit
+            deadlines.append(self.edge_time[bit.bit_length() - 1] + self.settle)
+
+        if self.repeat_delay is not None:
+            repeating = self.down_mask & self.held_mask
+            while repeating:
+                bit = repeating & -repeating
+                repeating ^= bit
+                deadlines.append(self.next_repeat[bit.bit_length() - 1])
+
+        return min(deadlines) if deadlines else None
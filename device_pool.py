@@ -0,0 +1,145 @@
+""" Run many simulated KPC devices in one process. Every device owns its
+GPIO simulator, keypad, LED board, KPC agent and FSM, so nothing is
+shared between them except the password store and the LED animator """
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from clock import REAL_CLOCK
+from FSM import FSM
+from GPIOSimulator_v5 import GPIOSimulator
+from KPC import KPC
+from keypad import Keypad
+from LED_board import LEDBoard
+from login_limiter import LoginLimiter
+from password_store import PasswordStore
+
+PASSWORD = '1234'
+
+# Recorded traces: (seconds since the previous key, key)
+LOGIN = [(0.0, '0'), (1.2, '1'), (0.3, '2'), (0.3, '3'), (0.3, '4'), (0.4, '*')]
+LIGHT_LED = [(2.0, '3'), (0.6, '5'), (0.5, '*')]
+CHANGE_PASSWORD = [(3.0, '*'), (0.8, '1'), (0.3, '2'), (0.3, '3'), (0.3, '4'), (0.4, '*')]
+LOGOUT = [(4.0, '#'), (0.7, '#')]
+SESSION = LOGIN + LIGHT_LED + CHANGE_PASSWORD + LOGOUT
+
+
+class Device:
+    """ One simulated KPC device, logged out and ready for a session """
+
+    def __init__(self, password_store, clock=REAL_CLOCK, animator=None, tracer=None):
+        self.clock = clock
+        self.gpio = GPIOSimulator(headless=True)
+        self.keypad = Keypad(self.gpio, clock=clock)
+        self.keypad.setup()
+        self.led_board = LEDBoard(self.gpio, clock, animator, tracer)
+        # Each device throttles its own failed logins, kept in memory only
+        self.agent = KPC(self.keypad, self.led_board, password_store, clock, LoginLimiter(clock=clock))
+        self.fsm = FSM(self.agent, tracer)
+        self.fsm.create_rules()
+        self.fsm.current_state = self.fsm.start_state
+
+    def press(self, key):
+        """ Press and release a key, then let the FSM handle it and any override
+        signal its action produces. Returns [(state_1, state_2, seconds)] for
+        the transitions made """
+        self.gpio.feed_keys(key)
+
+        transitions = []
+        while True:
+            state = self.fsm.current_state
+            start = time.perf_counter()
+            self.fsm.step()
+            transitions.append((state, self.fsm.current_state, time.perf_counter() - start))
+            if self.agent.override_signal == '' or self.fsm.is_final_state():
+                return transitions
+
+    def replay(self, trace, latencies=None, time_scale=1.0):
+        """ Play trace on the device, waiting out each delay (scaled by time_scale)
+        on the device clock. Transition latencies are collected in latencies,
+        a dict from (state_1, state_2) to a list of seconds """
+        for delay, key in trace:
+            self.clock.sleep(delay * time_scale)
+            for state_1, state_2, seconds in self.press(key):
+                if latencies is not None:
+                    latencies.setdefault((state_1, state_2), []).append(seconds)
+
+    async def type_keys_async(self, trace, time_scale=1.0):
+        """ Coroutine that presses the keys of trace, sleeping out each delay
+        (scaled by time_scale) on the event loop """
+        for delay, key in trace:
+            await asyncio.sleep(delay * time_scale)
+            self.gpio.feed_keys(key)
+
+    def shutdown(self):
+        """ Stop whatever the LED board is showing """
+        self.led_board.stop_animation()
+        self.led_board.jobs.clear()
+
+
+class DevicePool:
+    """ A pool of devices, each replaying traces on its own worker of a thread pool """
+
+    def __init__(self, size, password_store, clock=REAL_CLOCK, animator=None):
+        self.devices = [Device(password_store, clock, animator) for _ in range(size)]
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+    def replay(self, trace, time_scale=1.0):
+        """ Replay trace on every device at once, return (key events, wall seconds) """
+        start = time.perf_counter()
+        futures = [self.executor.submit(device.replay, trace, None, time_scale) for device in self.devices]
+        for future in futures:
+            future.result()
+        return len(self.devices) * len(trace), time.perf_counter() - start
+
+    def shutdown(self):
+        """ Stop the devices and the worker threads """
+        for device in self.devices:
+            device.shutdown()
+        self.executor.shutdown()
+
+
+async def replay_async(devices, trace, time_scale=1.0):
+    """ Replay trace on every device at once, with each device's FSM and its
+    scripted keys running as tasks on the current event loop instead of a
+    thread per device. Returns (key events, wall seconds) """
+    start = time.perf_counter()
+    await asyncio.gather(*[device.fsm.drive_async() for device in devices],
+                         *[device.type_keys_async(trace, time_scale) for device in devices])
+    return len(devices) * len(trace), time.perf_counter() - start
+
+
+def main(sizes=(1, 10, 100, 300), time_scale=0.01):
+    """ Replay SESSION on pools of growing size, with the user's think time
+    between keys scaled by time_scale, and print the aggregate throughput """
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'password.txt')
+        with open(pathname, 'w') as password_file:
+            password_file.write(PASSWORD)
+        password_store = PasswordStore(pathname, iterations=1000)
+
+        results = []
+        for size in sizes:
+            pool = DevicePool(size, password_store)
+            results.append(('thread pool', size) + pool.replay(SESSION, time_scale))
+            pool.shutdown()
+
+        for size in sizes:
+            devices = [Device(password_store) for _ in range(size)]
+            results.append(('asyncio', size) + asyncio.run(replay_async(devices, SESSION, time_scale)))
+            for device in devices:
+                device.shutdown()
+        password_store.flush()
+
+    base = {}
+    for driver, size, events, elapsed in results:
+        rate = events / elapsed
+        base.setdefault(driver, rate)
+        print('%-11s %4d devices: %6d events in %.3f s, %8.0f events/s (%.1fx one device)' %
+              (driver, size, events, elapsed, rate, rate / base[driver]))
+
+
+if __name__ == '__main__':
+    main()
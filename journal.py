@@ -0,0 +1,278 @@
+""" Binary append-only journal of what KPC devices do. Every key event, FSM
+transition and LED action is one fixed-size record, so a journal is cheap to
+append to and can be scanned through a memory map without parsing text """
+import json
+import mmap
+import os
+import struct
+import threading
+
+from clock import REAL_CLOCK
+from FSM_rules import ALL_KEYS, DIGITS, ENTRY_STATES, KPC_RULE_TABLE
+from tracing import Tracer
+
+MAGIC = b'KPCJ'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')     # Magic, version, length of the whole header in bytes
+# Wall clock time, device id, kind, source, target, signal, value
+RECORD = struct.Struct('<dIBBBcf')
+BATCH_SIZE = 256                    # Records buffered before they are written out
+
+# Record kinds, with what source, target, signal and value hold for each
+KEY = 1             # -, -, the signal, seconds the FSM waited for it
+TRANSITION = 2      # state ids, the signal that fired the rule, seconds the action took
+NO_MATCH = 3        # state id, -, the signal no rule matched, -
+ANIMATION = 4       # animation id, -, -, seconds the animation ran
+LED_JOB = 5         # LED, -, -, seconds the LED is lit
+
+KIND_NAMES = {KEY: 'key', TRANSITION: 'transition', NO_MATCH: 'no_match',
+              ANIMATION: 'animation', LED_JOB: 'led_job'}
+UNKNOWN = 0xff      # Id of a name missing from the journal's tables
+NO_SIGNAL = b'\x00'
+MASKED_DIGIT = b'd'  # A digit of a password, which is never journaled as it was typed
+
+# State names in the order they first appear in the rule table
+STATE_NAMES = tuple(dict.fromkeys(state for row in KPC_RULE_TABLE for state in (row[0], row[2])))
+ANIMATION_NAMES = ('animation', 'led', 'flash', 'twinkle', 'powering_down')
+
+
+class JournalError(Exception):
+    """ A file that is not a journal, or one of another version """
+
+
+def encode_header(state_names, animation_names):
+    """ Return the header of a new journal: the magic, the version and
+    the name tables the state and animation ids index """
+    names = json.dumps({'states': list(state_names), 'animations': list(animation_names)}).encode()
+    return HEADER.pack(MAGIC, VERSION, HEADER.size + len(names)) + names
+
+
+def decode_header(data):
+    """ Return (header length, state names, animation names) from the start of a journal """
+    if len(data) < HEADER.size:
+        raise JournalError('Journal header is truncated')
+    magic, version, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise JournalError('Not a KPC journal')
+    if version != VERSION:
+        raise JournalError('Unsupported journal version %d' % version)
+    if len(data) < length:
+        raise JournalError('Journal header is truncated')
+    names = json.loads(bytes(data[HEADER.size:length]).decode())
+    return length, tuple(names['states']), tuple(names['animations'])
+
+
+class Journal:
+    """ Class that appends records to a journal file. Records are buffered
+    and written out batch_size at a time, each batch with a single write;
+    flush writes out a partial batch and close also syncs the file to disk.
+    Safe to share between the devices and LED threads of a process """
+
+    def __init__(self, pathname, clock=REAL_CLOCK, batch_size=BATCH_SIZE,
+                 state_names=STATE_NAMES, animation_names=ANIMATION_NAMES):
+        """ Constructor. An existing journal is appended to, keeping its name tables """
+        self.pathname = pathname
+        self.clock = clock
+        self.batch_size = batch_size
+        self.records = 0                        # Records appended through this journal
+        self.__buffer = bytearray()
+        self.__buffered = 0
+        self.__lock = threading.Lock()
+        self.__fd = os.open(pathname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            self.__start(state_names, animation_names)
+        except BaseException:
+            os.close(self.__fd)
+            raise
+
+    def __start(self, state_names, animation_names):
+        """ internal function, write the header of a new journal or read the one of an existing journal """
+        size = os.fstat(self.__fd).st_size
+        if size == 0:
+            os.write(self.__fd, encode_header(state_names, animation_names))
+        else:
+            with open(self.pathname, 'rb') as journal_file:
+                # The header length is 16 bits, so the header is within the first 64 KiB
+                length, state_names, animation_names = decode_header(journal_file.read(0xffff))
+            # A crash may have cut the last record short; drop it so later records stay aligned
+            partial = (size - length) % RECORD.size
+            if partial:
+                os.ftruncate(self.__fd, size - partial)
+        self.state_ids = {name: index for index, name in enumerate(state_names)}
+        self.animation_ids = {name: index for index, name in enumerate(animation_names)}
+
+    def append(self, device_id, kind, source=0, target=0, signal=NO_SIGNAL, value=0.0):
+        """ Append one record, stamped with the clock's wall time """
+        with self.__lock:
+            self.__buffer += RECORD.pack(self.clock.wall_time(), device_id, kind, source, target, signal, value)
+            self.__buffered += 1
+            self.records += 1
+            if self.__buffered >= self.batch_size:
+                self.__write()
+
+    def __write(self):
+        """ internal function, write out the buffered records, the lock held """
+        if self.__buffer:
+            os.write(self.__fd, self.__buffer)
+            self.__buffer.clear()
+            self.__buffered = 0
+
+    def flush(self):
+        """ Write out the buffered records """
+        with self.__lock:
+            self.__write()
+
+    def close(self):
+        """ Write out the buffered records, sync the journal to disk and close it """
+        with self.__lock:
+            if self.__fd is None:
+                return
+            self.__write()
+            os.fsync(self.__fd)
+            os.close(self.__fd)
+            self.__fd = None
+
+    def tracer(self, device_id):
+        """ Return a tracer that journals what the device device_id does """
+        return JournalTracer(self, device_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def encode_signal(state, signal):
+    """ A signal got in state as the one byte a record holds """
+    if not signal:
+        return NO_SIGNAL
+    if state in ENTRY_STATES and signal in DIGITS:
+        return MASKED_DIGIT
+    return signal.encode()[:1]
+
+
+class JournalTracer(Tracer):
+    """ Tracer that appends what one device does to a journal. Give the
+    same tracer to the device's FSM and LED board """
+
+    def __init__(self, journal, device_id):
+        """ Constructor """
+        self.journal = journal
+        self.device_id = device_id
+        self.signal = NO_SIGNAL     # The latest signal, the one any transition that follows fired on, masked
+
+    def transition(self, state_1, state_2, action, seconds):
+        state_ids = self.journal.state_ids
+        self.journal.append(self.device_id, TRANSITION, state_ids.get(state_1, UNKNOWN),
+                            state_ids.get(state_2, UNKNOWN), self.signal, seconds)
+
+    def signal_wait(self, state, signal, seconds):
+        self.signal = encode_signal(state, signal)
+        self.journal.append(self.device_id, KEY, signal=self.signal, value=seconds)
+
+    def no_match(self, state, signal):
+        self.journal.append(self.device_id, NO_MATCH, self.journal.state_ids.get(state, UNKNOWN),
+                            signal=encode_signal(state, signal))
+
+    def animation(self, name, seconds):
+        self.journal.append(self.device_id, ANIMATION, self.journal.animation_ids.get(name, UNKNOWN),
+                            value=seconds)
+
+    def led_job(self, led, seconds):
+        self.journal.append(self.device_id, LED_JOB, led, value=seconds)
+
+
+class JournalReader:
+    """ Class that reads a journal through a memory map. Records are tuples
+    (time, device id, kind, source, target, signal, value) as packed by
+    RECORD; a record cut short by a crash is left out """
+
+    def __init__(self, pathname):
+        """ Constructor """
+        self.pathname = pathname
+        self.__view = None
+        with open(pathname, 'rb') as journal_file:
+            size = os.fstat(journal_file.fileno()).st_size
+            # An empty file cannot be mapped
+            self.__map = mmap.mmap(journal_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            self.start, self.state_names, self.animation_names = decode_header(self.__map)
+        except BaseException:
+            self.close()
+            raise
+        self.__count = (size - self.start) // RECORD.size
+        self.__view = memoryview(self.__map)[self.start:self.start + self.__count * RECORD.size]
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        return RECORD.iter_unpack(self.__view)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.__count
+        if not 0 <= index < self.__count:
+            raise IndexError('journal record index out of range')
+        return RECORD.unpack_from(self.__view, index * RECORD.size)
+
+    def close(self):
+        """ Release the memory map """
+        if self.__view is not None:
+            self.__view.release()
+            self.__view = None
+        if isinstance(self.__map, mmap.mmap):
+            self.__map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def state_name(self, state_id):
+        """ Name of the state state_id """
+        return self.state_names[state_id] if state_id < len(self.state_names) else None
+
+    def animation_name(self, animation_id):
+        """ Name of the animation animation_id """
+        return self.animation_names[animation_id] if animation_id < len(self.animation_names) else None
+
+    def describe(self, record):
+        """ Return a record as a line of text """
+        time, device_id, kind, source, target, signal, value = record
+        signal = signal.decode(errors='replace') if signal != NO_SIGNAL else ''
+        if kind == TRANSITION:
+            detail = '%s -> %s on %s, %.6f s' % (self.state_name(source), self.state_name(target), signal, value)
+        elif kind == KEY:
+            detail = '%s after %.6f s' % (signal, value)
+        elif kind == NO_MATCH:
+            detail = '%s in %s' % (signal, self.state_name(source))
+        elif kind == ANIMATION:
+            detail = '%s for %.3f s' % (self.animation_name(source), value)
+        elif kind == LED_JOB:
+            detail = 'LED %d for %.3f s' % (source, value)
+        else:
+            detail = '?'
+        return '%.6f device %d %-10s %s' % (time, device_id, KIND_NAMES.get(kind, kind), detail)
+
+    def key_trace(self, device_id):
+        """ Return the keys device_id got as a trace of (seconds, key) that
+        Device.replay can play again, the seconds counted from the end of
+        the transition the previous key led to, as Device.replay waits them.
+        The digits of a password are journaled masked and left out, so the
+        trace cannot replay password entry """
+        trace = []
+        previous = None     # Time the latest transition finished
+        for time, device, kind, _, _, signal, _ in self:
+            if device != device_id:
+                continue
+            if kind == TRANSITION:
+                previous = time
+            elif kind == KEY:
+                key = signal.decode(errors='replace')
+                # The KPC's own override signals are not keys
+                if key in ALL_KEYS:
+                    trace.append((0.0 if previous is None else max(0.0, time - previous), key))
+        return trace
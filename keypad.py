@@ -1,16 +1,36 @@
-import time
+import asyncio
+from collections import deque
+from clock import REAL_CLOCK
+from debounce import KeyDebouncer, DEBOUNCE_TIME, REPEAT_DELAY, REPEAT_INTERVAL
 from GPIOSimulator_v5 import GPIOSimulator, keypad_row_pins, \
     keypad_col_pins,PIN_KEYPAD_ROW_0,PIN_KEYPAD_COL_0, PIN_KEYPAD_COL_1,\
     PIN_KEYPAD_COL_2, PIN_KEYPAD_ROW_1, PIN_KEYPAD_ROW_2, PIN_KEYPAD_ROW_3
+from kpc_logging import get_logger
 
-GPIO = GPIOSimulator()
+logger = get_logger('keypad')
+
+# Number of most recent key presses kept in sequence_of_pressed_keys
+KEY_HISTORY = 64
+
+# Seconds between scans of the keypad when it is not event-driven
+POLL_INTERVAL = 0.12
 
 
 class Keypad:
     """ Class for Keypad: Interface to the simulated keypad """
-    def __init__(self):
-        """ Constructor for Keypad """
-        self.sequence_of_pressed_keys = []
+    def __init__(self, gpio=None, event_driven=True, clock=REAL_CLOCK, history=KEY_HISTORY,
+                 settle=DEBOUNCE_TIME, repeat_delay=REPEAT_DELAY, repeat_interval=REPEAT_INTERVAL):
+        """ Constructor for Keypad. gpio is the simulator the keypad is wired to,
+        a new one by default. With event_driven the keypad waits for
+        key events from the simulator, otherwise it falls back to polling.
+        history is how many of the latest key presses are remembered.
+        settle is the debounce time of polled keys; a key held for repeat_delay
+        seconds repeats every repeat_interval seconds, unless repeat_delay is None """
+        self.GPIO = GPIOSimulator() if gpio is None else gpio
+        self.event_driven = event_driven
+        self.clock = clock
+        # Ring buffer of the latest key presses, the oldest drop out as new ones arrive
+        self.sequence_of_pressed_keys = deque(maxlen=history)
         self.key_symbols = {(PIN_KEYPAD_ROW_0, PIN_KEYPAD_COL_0): "1",
                            (PIN_KEYPAD_ROW_0, PIN_KEYPAD_COL_1): "2",
                            (PIN_KEYPAD_ROW_0, PIN_KEYPAD_COL_2): "3",
@@ -24,62 +44,144 @@ class Keypad:
                            (PIN_KEYPAD_ROW_3, PIN_KEYPAD_COL_1): "0",
                            (PIN_KEYPAD_ROW_3, PIN_KEYPAD_COL_2): "#"
                            }
+        # The key for each bit of a scan_matrix bitmap, the keys in row-major order
+        self.bitmap_symbols = [self.key_symbols[(row, col)]
+                               for row in keypad_row_pins for col in keypad_col_pins]
+        self.key_bits = {symbol: 1 << index for index, symbol in enumerate(self.bitmap_symbols)}
 
-    @staticmethod
-    def setup():
+        # The simulator's key events are clean edges already, only polled keys bounce
+        self.debouncer = KeyDebouncer(len(self.bitmap_symbols), 0 if event_driven else settle,
+                                      repeat_delay, repeat_interval)
+        self.pending_keys = deque()     # Debounced key presses not yet returned
+
+    def setup(self):
         """ Method that sets up the row pins as outputs
         and the column pins as input """
 
         # Setup for row pins
-        GPIO.setup(keypad_row_pins[0], GPIO.OUT)
-        GPIO.setup(keypad_row_pins[1], GPIO.OUT)
-        GPIO.setup(keypad_row_pins[2], GPIO.OUT)
-        GPIO.setup(keypad_row_pins[3], GPIO.OUT)
+        self.GPIO.setup(keypad_row_pins[0], self.GPIO.OUT)
+        self.GPIO.setup(keypad_row_pins[1], self.GPIO.OUT)
+        self.GPIO.setup(keypad_row_pins[2], self.GPIO.OUT)
+        self.GPIO.setup(keypad_row_pins[3], self.GPIO.OUT)
 
         # Setup for column pins
-        GPIO.setup(keypad_col_pins[0], GPIO.IN, GPIO.LOW)
-        GPIO.setup(keypad_col_pins[1], GPIO.IN, GPIO.LOW)
-        GPIO.setup(keypad_col_pins[2], GPIO.IN, GPIO.LOW)
+        self.GPIO.setup(keypad_col_pins[0], self.GPIO.IN, self.GPIO.LOW)
+        self.GPIO.setup(keypad_col_pins[1], self.GPIO.IN, self.GPIO.LOW)
+        self.GPIO.setup(keypad_col_pins[2], self.GPIO.IN, self.GPIO.LOW)
+
+    def scan_matrix(self):
+        """ Method that scans all rows and columns in one call and
+        returns the bitmap of pressed keys, in the order of bitmap_symbols """
+        return self.GPIO.scan_matrix()
+
+    def pressed_keys(self):
+        """ Method that returns every key currently being pressed,
+        so chords of several keys can be detected """
+        bitmap = self.scan_matrix()
+        return [symbol for index, symbol in enumerate(self.bitmap_symbols) if bitmap >> index & 1]
 
     def do_polling(self):
         """ Method that determines the key currently
         being pressed on the keypad """
 
-        # Iterating through all the pins in the keypad grid
-        for row in keypad_row_pins:
-
-            # Setting row pins to state=HIGH
-            GPIO.output(row, GPIO.HIGH)
-
-            for col in keypad_col_pins:
-
-                # Reading the state of a column pin in a row
-                if GPIO.input(col) == GPIO.HIGH:
-
-                    # A key (row, col) is being pressed
-                    print('Registered keypress: ', self.key_symbols[(row, col)])
-                    return self.key_symbols[(row, col)]
-
-            # Resetting the current pin row in order to check the next pin row
-            GPIO.output(row, GPIO.LOW)
+        bitmap = self.scan_matrix()
 
         # No key is being pressed
-        return None
-
-    def get_next_signal(self):
-        """ Method that initiate repeated calls to
-        do_polling until a key press is detected """
-        print('Calling get_next_signal.')
-
-        key = None
-        while key is None:
-
-            # Checking if a key is pressed and saving the pressed key as a tuple
-            key = self.do_polling()
-
-            if key is not None:
-                # Adding the pressed key to the sequence of pressed keys
-                self.sequence_of_pressed_keys.append(key)
+        if bitmap == 0:
+            return None
+
+        # The first pressed key in row-major order, as found by a row by row scan
+        key = self.bitmap_symbols[(bitmap & -bitmap).bit_length() - 1]
+        # Not the key itself, it may be a password digit
+        logger.debug('Registered keypress')
+        return key
+
+    def get_next_signal(self, timeout=None):
+        """ Method that waits for the next key press and returns it.
+        Returns None if no key is pressed within timeout seconds """
+        key = self.next_key(timeout)
+
+        if key is not None:
+            # Adding the pressed key to the sequence of pressed keys
+            self.sequence_of_pressed_keys.append(key)
+
+        return key
+
+    def next_key(self, timeout=None):
+        """ Method that returns the next debounced key press or auto-repeat,
+        or None if there is none within timeout seconds. Event-driven, it
+        sleeps on the simulator's key events; otherwise it scans the keypad
+        every POLL_INTERVAL seconds, or sooner when a bounce settles or a key repeats """
+        deadline = None if timeout is None else self.clock.now() + timeout
+
+        while not self.pending_keys:
+            now = self.clock.now()
+            wake = self.debouncer.next_deadline()
+            if deadline is not None and (wake is None or deadline < wake):
+                wake = deadline
+            wait = None if wake is None else max(wake - now, 0)
+
+            if self.event_driven:
+                # Sleeping on the simulator's key event queue until a key arrives
+                key = self.clock.receive(self.GPIO.get_key_event, wait)
+                held, _ = self.GPIO.read_key_edges()
+                latched = 0 if key is None else self.key_bits[key]
+            else:
+                held, latched = self.GPIO.read_key_edges()
+
+            for index in self.debouncer.update(self.clock.now(), held, latched):
+                self.pending_keys.append(self.bitmap_symbols[index])
+
+            if self.pending_keys:
+                break
+            # Giving up if the timeout has passed
+            if deadline is not None and self.clock.now() >= deadline:
+                return None
+            if not self.event_driven:
+                # Controlling the delay between polling
+                self.clock.sleep(POLL_INTERVAL if wait is None else min(POLL_INTERVAL, wait))
+
+        key = self.pending_keys.popleft()
+        # Not the key itself, it may be a password digit
+        logger.debug('Registered keypress')
+        return key
+
+    def last_key(self):
+        """ Method that returns the latest key pressed, or None """
+        return self.sequence_of_pressed_keys[-1] if self.sequence_of_pressed_keys else None
+
+    def key_history(self):
+        """ Method that returns a snapshot of the remembered key presses, oldest first """
+        return tuple(self.sequence_of_pressed_keys)
+
+    def key_stream(self, timeout=None):
+        """ Generator that yields key presses as they arrive, one at a time.
+        Ends if no key is pressed within timeout seconds """
+        while True:
+            key = self.get_next_signal(timeout)
+            if key is None:
+                return
+            yield key
+
+    async def get_next_signal_async(self):
+        """ Coroutine that waits for the next key press without
+        blocking the event loop, and returns it. Always event-driven """
+        while not self.pending_keys:
+            wake = self.debouncer.next_deadline()
+            try:
+                key = await asyncio.wait_for(self.GPIO.get_key_event_async(),
+                                             None if wake is None else max(wake - self.clock.now(), 0))
+            except asyncio.TimeoutError:
+                key = None
+            held, _ = self.GPIO.read_key_edges()
+            latched = 0 if key is None else self.key_bits[key]
+            for index in self.debouncer.update(self.clock.now(), held, latched):
+                self.pending_keys.append(self.bitmap_symbols[index])
+
+        key = self.pending_keys.popleft()
+
+        # Adding the pressed key to the sequence of pressed keys
+        self.sequence_of_pressed_keys.append(key)
+
+        return key
 
-            # Controlling the delay between polling
-            time.sleep(0.12)
@@ -0,0 +1,69 @@
+""" Logging for the KPC system. Every module logs to a child of the 'kpc'
+logger; setup_logging sends those records through a queue to a listener
+thread, so the FSM, keypad and LED board never wait for the terminal """
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOGGER_NAME = 'kpc'
+FORMAT = '%(message)s'
+
+_listener = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that only merges the arguments into the message before
+    queueing a record, instead of formatting and copying every record """
+
+    def prepare(self, record):
+        if record.exc_info:
+            return super().prepare(record)
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def get_logger(name):
+    """ Return the logger of a KPC module, e.g. get_logger('fsm') """
+    return logging.getLogger(LOGGER_NAME + '.' + name)
+
+
+def setup_logging(level=logging.INFO, handler=None):
+    """ Log KPC records of level and above to handler, a stream handler on
+    stderr by default, from a background thread. Calling it again replaces
+    the previous setup. Returns the QueueListener """
+    stop_logging()
+
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(FORMAT))
+
+    # Unbounded, so logging never blocks the caller
+    records = queue.SimpleQueue()
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(_QueueHandler(records))
+
+    global _listener
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """ Write out the queued records and detach the listener set up by setup_logging """
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# Queued records are written out before the interpreter exits
+atexit.register(stop_logging)
@@ -0,0 +1,77 @@
+""" Timed LED jobs: light an LED for some seconds, with any number of
+jobs on the same board running at once """
+import heapq
+import itertools
+import threading
+
+from clock import REAL_CLOCK
+from GPIOSimulator_v5 import N_LEDS
+
+
+class LEDJobScheduler:
+    """ Keeps the LEDs of a board lit for as long as their jobs last. The
+    jobs' end times are kept in a min-heap, and one timer thread sleeps
+    until the earliest of them; it runs while there are jobs and exits when idle """
+
+    def __init__(self, board, clock=REAL_CLOCK):
+        """ Constructor """
+        self.board = board
+        self.clock = clock
+        self.__heap = []                        # (end time, tie breaker, LED)
+        self.__counter = itertools.count()
+        self.__lit_until = [None] * N_LEDS      # Latest end time of each LED's jobs, None if unlit
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def add(self, led, seconds):
+        """ Light led for seconds from now, on top of whatever else is lit """
+        with self.__condition:
+            end = self.clock.now() + seconds
+            heapq.heappush(self.__heap, (end, next(self.__counter), led))
+            if self.__lit_until[led] is None or self.__lit_until[led] < end:
+                was_lit = self.__lit_until[led] is not None
+                self.__lit_until[led] = end
+                if not was_lit:
+                    self.board.show_pattern(self.pattern())
+            if self.__thread is None:
+                self.clock.attach()
+                self.__thread = threading.Thread(target=self.__run, name='LEDJobScheduler', daemon=True)
+                self.__thread.start()
+            self.clock.notify(self.__condition)
+
+    def clear(self):
+        """ End every job now and turn their LEDs off """
+        with self.__condition:
+            self.__heap.clear()
+            self.__lit_until = [None] * N_LEDS
+            self.board.show_pattern(0)
+            self.clock.notify(self.__condition)
+
+    def pattern(self):
+        """ Bitmap of the LEDs lit by jobs """
+        return sum(1 << led for led, until in enumerate(self.__lit_until) if until is not None)
+
+    def lit_until(self):
+        """ Dict from each LED lit by jobs to the time on the clock its last job ends """
+        with self.__condition:
+            return {led: until for led, until in enumerate(self.__lit_until) if until is not None}
+
+    def __run(self):
+        """ internal function, the timer thread: sleep until the earliest end
+        time and turn the LED off unless a later job still keeps it lit """
+        with self.__condition:
+            while self.__heap:
+                end, _, led = self.__heap[0]
+                delay = end - self.clock.now()
+                if delay > 0:
+                    # A new job may end earlier and wake us up
+                    self.clock.wait(self.__condition, delay)
+                    continue
+
+                heapq.heappop(self.__heap)
+                if self.__lit_until[led] is not None and self.__lit_until[led] <= end:
+                    self.__lit_until[led] = None
+                    self.board.show_pattern(self.pattern())
+
+            self.__thread = None
+            self.clock.detach()
@@ -0,0 +1,129 @@
+""" Persistence-of-vision refresh for the charlieplexed LED board.
+Charlieplexing lights at most one LED at a time, so to show several LEDs
+the refresh engine lights them one after another, fast enough that they
+all appear lit at once. Lighting an LED for only some of its turns (PWM)
+dims it """
+import threading
+
+from GPIOSimulator_v5 import N_LEDS
+
+REFRESH_RATE = 2000     # Slots per second, one LED (or none) lit per slot
+PWM_LEVELS = 8          # Brightness steps of an LED
+DISPLAY_RATE = 25       # Times per second the LED states are shown, about what the eye resolves
+
+
+class RefreshEngine:
+    """ Class that multiplexes an LED pattern on an LEDBoard. The pattern
+    is compiled into a schedule of slots, each the pin masks of one LED or
+    None, which the engine steps through rate times per second """
+
+    def __init__(self, board, rate=REFRESH_RATE, levels=PWM_LEVELS, display_rate=DISPLAY_RATE, clock=None):
+        """ Constructor. Slots are timed on clock, by default the board's """
+        self.board = board
+        self.clock = board.clock if clock is None else clock
+        self.rate = rate
+        self.levels = levels
+        self.display_rate = display_rate
+        self.pattern = 0                    # Bitmap of the LEDs to show
+        self.brightness = {}                # LED -> brightness from 0 to 1 of the LEDs in pattern
+        self.lit_slots = [0] * N_LEDS       # Slots each LED was lit in since reset_stats
+        self.slots = 0                      # Slots refreshed since reset_stats
+        self.missed_slots = 0               # Slots skipped because the engine fell behind
+
+        self.__schedule = ((None, -1),)     # (pin masks, LED) per slot
+        self.__index = 0
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    def set_pattern(self, pattern, brightness=None):
+        """ Show the LEDs whose bits are set in pattern, e.g. 0b100101 for
+        LEDs 0, 2 and 5. brightness maps LEDs to a brightness from 0 to 1,
+        LEDs not in it are at full brightness """
+        brightness = brightness or {}
+        leds = [led for led in range(N_LEDS) if pattern >> led & 1]
+        steps = {led: max(0, min(self.levels, round(brightness.get(led, 1.0) * self.levels)))
+                 for led in leds}
+
+        # Each PWM step gives every LED one slot, in which it is lit if its brightness reaches that step
+        schedule = tuple((self.board.pin_masks_pr_led[led], led) if step < steps[led] else (None, -1)
+                         for step in range(self.levels) for led in leds)
+
+        self.pattern = pattern
+        self.brightness = {led: steps[led] / self.levels for led in leds}
+        # Swapped in whole, so a running refresh never sees half a schedule
+        self.__index = 0
+        self.__schedule = schedule or ((None, -1),)
+
+    def refresh(self, slots=1):
+        """ Show the next slots of the schedule back to back, without waiting """
+        setup_charlieplexing = self.board.GPIO.setup_charlieplexing
+        lit_slots = self.lit_slots
+        schedule = self.__schedule
+        index = self.__index
+        if index >= len(schedule):
+            # The pattern changed under a concurrent refresh
+            index = 0
+        for _ in range(slots):
+            masks, led = schedule[index]
+            if masks is None:
+                setup_charlieplexing(0, 0)
+            else:
+                setup_charlieplexing(*masks)
+                lit_slots[led] += 1
+            index += 1
+            if index == len(schedule):
+                index = 0
+        self.__index = index
+        self.slots += slots
+
+    def run(self, seconds=None):
+        """ Refresh at rate slots per second for seconds on the board's clock,
+        or until stop is called if seconds is None.
+        Slots are timed against absolute deadlines; when the engine falls
+        behind by more than a slot it skips ahead instead of catching up """
+        start = self.clock.now()
+        slot_time = 1.0 / self.rate
+        n_slots = None if seconds is None else int(seconds * self.rate)
+        slots_per_display = max(1, int(self.rate / self.display_rate))
+        slot = 0
+        while (n_slots is None or slot < n_slots) and not self.__stop.is_set():
+            delay = start + slot * slot_time - self.clock.now()
+            if delay > 0:
+                self.clock.sleep(delay)
+            elif delay < -slot_time:
+                behind = int(-delay / slot_time)
+                if n_slots is not None:
+                    behind = min(behind, n_slots - slot)
+                self.missed_slots += behind
+                slot += behind
+                continue
+            self.refresh()
+            slot += 1
+            if slot % slots_per_display == 0:
+                # What the eye sees: every LED lit since the last display
+                self.board.GPIO.show_leds_states()
+
+    def start(self):
+        """ Refresh on a background thread until stop is called """
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.run, name='RefreshEngine', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        """ Stop the background refresh and turn the LEDs off """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.board.GPIO.setup_charlieplexing(0, 0)
+
+    def reset_stats(self):
+        """ Start counting slots and lit slots from zero """
+        self.lit_slots = [0] * N_LEDS
+        self.slots = 0
+        self.missed_slots = 0
+
+    def duty_cycles(self):
+        """ Fraction of the refreshed slots each LED was lit in, per LED """
+        return [lit / self.slots if self.slots else 0.0 for lit in self.lit_slots]
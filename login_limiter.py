@@ -0,0 +1,71 @@
+""" Throttling of login attempts: after repeated wrong passwords the KPC
+is locked for a while, longer for every further failure """
+from clock import REAL_CLOCK
+from kpc_logging import get_logger
+from password_store import write_atomic
+
+logger = get_logger('login_limiter')
+
+# Seconds the KPC is locked after n consecutive failed logins, n indexing the table;
+# beyond its end the last entry applies
+BACKOFF_TABLE = (0, 0, 0, 1, 2, 4, 8, 16, 30, 60, 120, 300)
+
+
+class LoginLimiter:
+    """ Class that counts consecutive failed logins and locks out further
+    attempts following BACKOFF_TABLE. With a pathname the count and the
+    lockout survive a restart; the lockout is kept as wall clock time """
+
+    def __init__(self, pathname=None, clock=REAL_CLOCK, table=BACKOFF_TABLE):
+        """ Constructor """
+        self.pathname = pathname
+        self.clock = clock
+        self.table = table
+        self.failures = 0           # Failed logins since the last successful one
+        self.locked_until = 0.0     # Wall clock time the lockout ends
+        if pathname is not None:
+            self.__load()
+
+    def __load(self):
+        """ internal function, read the persisted state, if any """
+        try:
+            with open(self.pathname, 'r') as lockout_file:
+                failures, locked_until = lockout_file.read().split()
+            self.failures, self.locked_until = int(failures), float(locked_until)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning('Ignoring malformed lockout file %s', self.pathname)
+
+    def __save(self):
+        """ internal function, persist the state """
+        if self.pathname is not None:
+            write_atomic(self.pathname, '%d %r\n' % (self.failures, self.locked_until))
+
+    def remaining(self):
+        """ Seconds left of the current lockout, 0 if logins are allowed """
+        now = self.clock.wall_time()
+        remaining = self.locked_until - now
+        if remaining <= 0:
+            return 0
+        if remaining > self.table[-1]:
+            # The wall clock was set back; the lockout must not outlast the longest in the table
+            self.locked_until = now + self.table[-1]
+            self.__save()
+            return self.table[-1]
+        return remaining
+
+    def record_failure(self):
+        """ Count a failed login and start the lockout it earns """
+        self.failures += 1
+        lockout = self.table[min(self.failures, len(self.table) - 1)]
+        self.locked_until = self.clock.wall_time() + lockout
+        self.__save()
+        return lockout
+
+    def record_success(self):
+        """ Reset the count after a successful login """
+        if self.failures or self.locked_until:
+            self.failures = 0
+            self.locked_until = 0.0
+            self.__save()
@@ -1,20 +1,38 @@
 """ The main function"""
+from GPIOSimulator_v5 import GPIOSimulator
 from KPC import KPC
 from keypad import Keypad
 from LED_board import LEDBoard
 from FSM import FSM
+from checkpoint import Checkpointer
+from journal import Journal
+from kpc_logging import setup_logging
 
 
 def main():
     """ Main function of the entire system """
-    keypad = Keypad()
+    setup_logging()
+
+    # The keypad and the LED board are wired to the same GPIO
+    gpio = GPIOSimulator()
+
+    keypad = Keypad(gpio)
     keypad.setup()
 
-    l_board = LEDBoard()
+    # Keys, transitions and LED actions are journaled for post-mortem analysis and replay
+    journal = Journal('kpc_journal.bin')
+    tracer = journal.tracer(0)
+
+    l_board = LEDBoard(gpio, tracer=tracer)
 
     kpc_agent = KPC(keypad, l_board)
 
-    fsm = FSM(kpc_agent)
-    fsm.main_loop()
+    fsm = FSM(kpc_agent, tracer)
+    # A restarted process resumes the session the previous one was in
+    fsm.checkpointer = Checkpointer('kpc_checkpoint.txt', fsm)
+    try:
+        fsm.main_loop()
+    finally:
+        journal.close()
 
 RUN_MAIN = main()
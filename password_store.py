@@ -0,0 +1,221 @@
+""" Password storage for the KPC agent: the password file holds a salted
+PBKDF2 hash, which is kept in memory between login attempts """
+import hashlib
+import hmac
+import os
+import tempfile
+import threading
+
+from kpc_logging import get_logger
+
+logger = get_logger('password_store')
+
+HASH_NAME = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 100000
+SALT_SIZE = 16
+WRITE_DELAY = 0.005     # Seconds a write waits for further changes to coalesce with
+
+
+def write_atomic(pathname, data):
+    """ Replace the content of pathname with data so that a crash leaves
+    either the old or the new content: write a temporary file in the same
+    directory, fsync it, rename it over pathname and fsync the directory """
+    directory = os.path.dirname(os.path.abspath(pathname))
+    fd, temp_pathname = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(pathname) + '.')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_pathname, pathname)
+    except BaseException:
+        os.unlink(temp_pathname)
+        raise
+
+    # The rename is only durable once the directory entry is on disk
+    if os.name == 'posix':
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class CoalescingWriter:
+    """ Background writer for data that only matters in its newest version,
+    such as a file that is replaced as a whole. Items submitted in quick
+    succession are coalesced: the writer thread waits delay seconds, then
+    calls write with the newest item only. It runs while there are items to
+    write and exits when idle. A failed write is logged and reported by the
+    next flush; the writer goes on with any newer item """
+
+    def __init__(self, write, delay, name='CoalescingWriter'):
+        """ Constructor. write is called with each item to write, from the writer thread """
+        self.write = write
+        self.delay = delay
+        self.name = name
+        self.__condition = threading.Condition()
+        self.__pending = None           # Newest item not yet handed to write
+        self.__thread = None            # Writer thread, running while there are items to write
+        self.__error = None             # Exception of the latest failed write, until flush reports it
+
+    def busy(self):
+        """ Return True while an item waits to be written or is being written """
+        return self.__thread is not None
+
+    def submit(self, item):
+        """ Have item written in the background, replacing any item still waiting """
+        with self.__condition:
+            self.__pending = item
+            if self.__thread is None:
+                # Not a daemon, so the interpreter waits for the write before exiting
+                self.__thread = threading.Thread(target=self.__run, name=self.name)
+                self.__thread.start()
+
+    def cancel(self):
+        """ Drop the item waiting to be written, if any """
+        with self.__condition:
+            self.__pending = None
+
+    def __run(self):
+        """ internal function, the writer thread: write the newest pending
+        item until no more arrive, then exit """
+        with self.__condition:
+            try:
+                while self.__pending is not None:
+                    # Give items submitted right after this one the chance to share the write
+                    self.__condition.wait(self.delay)
+                    item, self.__pending = self.__pending, None
+                    if item is None:
+                        # Cancelled while waiting
+                        break
+
+                    self.__condition.release()
+                    try:
+                        self.write(item)
+                    except Exception as error:
+                        logger.error('%s failed to write: %s', self.name, error)
+                        self.__error = error
+                    finally:
+                        self.__condition.acquire()
+            finally:
+                self.__thread = None
+                self.__condition.notify_all()
+
+    def flush(self, timeout=None):
+        """ Wait until every submitted item is written, return False on timeout.
+        Raises the exception of a write that failed since the last flush """
+        with self.__condition:
+            done = self.__condition.wait_for(lambda: self.__thread is None, timeout)
+            error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+        return done
+
+
+def hash_password(password, iterations=DEFAULT_ITERATIONS, salt=None):
+    """ Hash password with a fresh random salt and return the record
+    stored in the password file: 'pbkdf2_sha256$iterations$salt$hash' """
+    if salt is None:
+        salt = os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return '$'.join([HASH_NAME, str(iterations), salt.hex(), digest.hex()])
+
+
+def parse_record(record):
+    """ Split a password file record into (iterations, salt, hash),
+    or return None if it is not a hash record (a legacy plaintext password) """
+    fields = record.split('$')
+    if len(fields) != 4 or fields[0] != HASH_NAME:
+        return None
+    return int(fields[1]), bytes.fromhex(fields[2]), bytes.fromhex(fields[3])
+
+
+class PasswordStore:
+    """ Class that checks and replaces the password in the password file.
+    The stored hash is cached and only read again when the file's inode,
+    modification time or size changes. New passwords take effect at once
+    and are written to the file by a background writer, which coalesces
+    changes made in quick succession into a single atomic write """
+
+    def __init__(self, pathname, iterations=DEFAULT_ITERATIONS, write_delay=WRITE_DELAY):
+        """ Constructor """
+        self.pathname = pathname
+        self.iterations = iterations    # PBKDF2 iterations for newly hashed passwords
+        self.write_delay = write_delay
+        self.write_count = 0            # Number of writes (and fsyncs) made to the file
+
+        self.__signature = None         # (inode, mtime, size) of the file the cache was read from
+        self.__hash = None              # (iterations, salt, hash) of the stored password
+
+        self.__condition = threading.Condition()
+        self.__writer = CoalescingWriter(self.__write_pending, write_delay, 'PasswordWriter')
+
+    def __file_signature(self):
+        """ internal function, stat the password file """
+        stat = os.stat(self.pathname)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def __refresh(self):
+        """ internal function, read the password file again if it has changed """
+        # While a change is waiting to be written the cache is newer than the file
+        if self.__writer.busy():
+            return
+
+        signature = self.__file_signature()
+        if signature == self.__signature:
+            return
+
+        with open(self.pathname, 'r') as password_file:
+            record = password_file.read().strip()
+
+        stored_hash = parse_record(record)
+        if stored_hash is None:
+            # Legacy plaintext password file: replace the password with its hash
+            record = hash_password(record, self.iterations)
+            self.__write(record)
+            signature = self.__file_signature()
+            stored_hash = parse_record(record)
+
+        self.__signature = signature
+        self.__hash = stored_hash
+
+    def __write(self, record):
+        """ internal function, overwrite the password file with record """
+        write_atomic(self.pathname, record)
+        self.write_count += 1
+
+    def __write_pending(self, record):
+        """ internal function, the background write of a changed password """
+        try:
+            self.__write(record)
+            signature = self.__file_signature()
+        except OSError:
+            # The cache no longer matches the file, read it again once the writer is done
+            with self.__condition:
+                self.__signature = None
+            raise
+        with self.__condition:
+            self.__signature = signature
+
+    def verify(self, password):
+        """ Return True if password matches the stored password """
+        with self.__condition:
+            self.__refresh()
+            iterations, salt, stored_digest = self.__hash
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        return hmac.compare_digest(digest, stored_digest)
+
+    def set_password(self, password):
+        """ Replace the stored password. It is used for verification at once,
+        call flush to wait until it is safely in the password file """
+        record = hash_password(password, self.iterations)
+        with self.__condition:
+            self.__hash = parse_record(record)
+            self.__writer.submit(record)
+
+    def flush(self, timeout=None):
+        """ Wait until every password change is written, return False on timeout.
+        Raises the OSError of a write that failed; the password file then
+        keeps the password it had, which is used again """
+        return self.__writer.flush(timeout)
@@ -0,0 +1,91 @@
+""" Replay recorded keystroke traces through the real FSM, KPC and keypad
+and report how many key events per second the pipeline processes """
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from clock import SimulatedClock
+from device_pool import Device, PASSWORD, SESSION
+from LED_animation import LEDAnimator
+from password_store import PasswordStore
+from tracing import PrometheusTracer
+
+
+def percentile(sorted_values, fraction):
+    """ The value below which fraction of sorted_values lie """
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_sessions(password_store, sessions, trace=SESSION, tracer=None):
+    """ Replay trace on a fresh device per session, return (events, wall seconds, latencies, clock).
+    The trace delays and LED animations pass in simulated time """
+    clock = SimulatedClock()
+    animator = LEDAnimator(clock)
+    latencies = {}
+    elapsed = 0.0
+    for _ in range(sessions):
+        device = Device(password_store, clock, animator, tracer)
+        start = time.perf_counter()
+        device.replay(trace, latencies)
+        elapsed += time.perf_counter() - start
+        device.shutdown()
+    events = sessions * len(trace)
+    return events, elapsed, latencies, clock
+
+
+def main(sessions=200, metrics=None):
+    """ Replay SESSION traces and print throughput, latency percentiles and allocations.
+    If metrics is given, replay them once more with tracing enabled, print
+    the tracing overhead and write the metrics there ('-' for stdout) """
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'password.txt')
+        with open(pathname, 'w') as password_file:
+            password_file.write(PASSWORD)
+        # A low iteration count keeps hashing from dominating the pipeline
+        password_store = PasswordStore(pathname, iterations=1000)
+
+        run_sessions(password_store, 5)
+        events, elapsed, latencies, clock = run_sessions(password_store, sessions)
+
+        tracemalloc.start()
+        blocks_before = sys.getallocatedblocks()
+        before = tracemalloc.take_snapshot()
+        run_sessions(password_store, 20)
+        after = tracemalloc.take_snapshot()
+        blocks_after = sys.getallocatedblocks()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if metrics is not None:
+            tracer = PrometheusTracer()
+            traced_events, traced_elapsed, _, _ = run_sessions(password_store, sessions, tracer=tracer)
+
+        password_store.flush()
+
+    allocated = sum(stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0)
+    all_latencies = sorted(value for values in latencies.values() for value in values)
+
+    print('replayed %d key events (%.0f s of simulated time) in %.3f s, %.0fx real time' %
+          (events, clock.now(), elapsed, clock.now() / elapsed))
+    print('throughput: %.0f events/s' % (events / elapsed))
+    print('transition latency: p50 %.1f us, p90 %.1f us, p99 %.1f us' %
+          tuple(percentile(all_latencies, q) * 1e6 for q in (0.5, 0.9, 0.99)))
+    for (state_1, state_2), values in sorted(latencies.items()):
+        values.sort()
+        print('  %-18s -> %-18s n=%-5d p50 %7.1f us  p99 %7.1f us' %
+              (state_1, state_2, len(values), percentile(values, 0.5) * 1e6, percentile(values, 0.99) * 1e6))
+    print('allocations: %d blocks still held after 20 sessions (%+d interpreter blocks), peak %.0f KiB traced' %
+          (allocated, blocks_after - blocks_before, peak / 1024))
+
+    if metrics is not None:
+        print('with tracing: %.0f events/s' % (traced_events / traced_elapsed))
+        if metrics == '-':
+            tracer.export()
+        else:
+            tracer.write(metrics)
+
+
+if __name__ == '__main__':
+    main(metrics=sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,54 @@
+""" Tests of checkpointing a device and resuming it """
+import os
+
+from checkpoint import Checkpointer
+from clock import SimulatedClock
+from device_pool import CHANGE_PASSWORD, LIGHT_LED, LOGIN, LOGOUT, PASSWORD, Device
+from password_store import PasswordStore
+
+
+def make_device(tmp_path, clock):
+    """ A device on a password store of its own, checkpointed to tmp_path """
+    pathname = tmp_path / 'password.txt'
+    if not pathname.exists():
+        pathname.write_text(PASSWORD)
+    device = Device(PasswordStore(str(pathname), iterations=1000), clock)
+    device.fsm.checkpointer = Checkpointer(str(tmp_path / 'checkpoint.txt'), device.fsm, interval=0.0)
+    return device
+
+
+def test_round_trip(tmp_path):
+    clock = SimulatedClock(1000.0)
+    device = make_device(tmp_path, clock)
+    device.replay(LOGIN + LIGHT_LED)
+    assert device.fsm.checkpointer.flush(5.0)
+    device.shutdown()
+
+    resumed = make_device(tmp_path, clock)
+    assert resumed.fsm.checkpointer.restore()
+    assert resumed.fsm.current_state == device.fsm.current_state == 'S-Active'
+    assert (resumed.agent.led_id, resumed.agent.led_duration) == (device.agent.led_id, device.agent.led_duration)
+
+    resumed.replay(LOGOUT)
+    assert resumed.fsm.current_state == 'S-Done'
+    resumed.fsm.finish()
+    assert not os.path.exists(resumed.fsm.checkpointer.pathname)
+
+
+def test_no_password_persisted(tmp_path):
+    clock = SimulatedClock(1000.0)
+    device = make_device(tmp_path, clock)
+    # Stop halfway through typing the new password
+    device.replay(LOGIN + CHANGE_PASSWORD[:3])
+    assert device.fsm.checkpointer.flush(5.0)
+    device.shutdown()
+
+    text = (tmp_path / 'checkpoint.txt').read_text()
+    assert 'password_buffer' not in text and 'new_password' not in text
+    assert 'last_signal' not in text
+
+    resumed = make_device(tmp_path, clock)
+    assert resumed.fsm.checkpointer.restore()
+    # The entry starts over
+    assert resumed.fsm.current_state == 'S-Read-2'
+    assert resumed.agent.password_buffer == resumed.agent.new_password == ''
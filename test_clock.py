@@ -0,0 +1,39 @@
+""" Tests of the simulated clock's stepping from one deadline to the next """
+from clock import SimulatedClock
+from GPIOSimulator_v5 import GPIOSimulator
+from LED_board import LEDBoard
+
+
+def test_flash_next_to_long_job():
+    clock = SimulatedClock()
+    board = LEDBoard(GPIOSimulator(headless=True), clock)
+    shown = []
+    show_masks = board.show_masks
+    board.show_masks = lambda masks: (shown.append(clock.now()), show_masks(masks))
+
+    board.light_led_for(0, 3600)
+    flash = board.flash_all_leds(3)
+    clock.sleep(3.5)
+
+    # Six frames and the final off, each at its own time
+    assert shown == [0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0]
+    assert flash.done()
+    assert board.jobs.lit_until() == {0: 3600.0}
+    assert clock.now() == 3.5
+
+    clock.sleep(3600)
+    assert board.jobs.lit_until() == {}
+    assert clock.now() == 3603.5
+
+
+def test_jobs_end_in_order():
+    clock = SimulatedClock(100.0)
+    board = LEDBoard(GPIOSimulator(headless=True), clock)
+    for led, seconds in ((1, 30), (2, 10), (3, 20)):
+        board.light_led_for(led, seconds)
+
+    lit = []
+    for _ in range(4):
+        lit.append(sorted(board.jobs.lit_until()))
+        clock.sleep(10)
+    assert lit == [[1, 2, 3], [1, 3], [1], []]
@@ -0,0 +1,60 @@
+""" Tests of the journal's handling of a record cut short by a crash, and of password digits """
+import os
+
+from clock import SimulatedClock
+from device_pool import CHANGE_PASSWORD, LOGIN, PASSWORD, Device
+from journal import Journal, JournalReader, KEY, MASKED_DIGIT, RECORD, TRANSITION
+from password_store import PasswordStore
+
+
+def write_journal(pathname, keys):
+    """ Journal one KEY record per key and return the file size """
+    with Journal(pathname, clock=SimulatedClock(1000.0)) as journal:
+        for key in keys:
+            journal.append(7, KEY, signal=key.encode(), value=0.5)
+    return os.path.getsize(pathname)
+
+
+def tear(pathname, size, count):
+    """ Cut count bytes off the last record, as a crash mid-write would """
+    with open(pathname, 'r+b') as journal_file:
+        journal_file.truncate(size - count)
+
+
+def test_reader_leaves_out_torn_record(tmp_path):
+    pathname = str(tmp_path / 'journal.bin')
+    tear(pathname, write_journal(pathname, '123'), 5)
+    with JournalReader(pathname) as reader:
+        assert len(reader) == 2
+        assert [record[5] for record in reader] == [b'1', b'2']
+
+
+def test_append_truncates_torn_record(tmp_path):
+    pathname = str(tmp_path / 'journal.bin')
+    size = write_journal(pathname, '123')
+    tear(pathname, size, 5)
+    # Reopening drops the torn record, so the new ones stay aligned
+    assert write_journal(pathname, '45') == size - RECORD.size + 2 * RECORD.size
+    with JournalReader(pathname) as reader:
+        assert [record[5] for record in reader] == [b'1', b'2', b'4', b'5']
+        assert all(record[1] == 7 and record[2] == KEY for record in reader)
+
+
+def test_password_digits_masked(tmp_path):
+    store_pathname = tmp_path / 'password.txt'
+    store_pathname.write_text(PASSWORD)
+    pathname = str(tmp_path / 'journal.bin')
+    clock = SimulatedClock(1000.0)
+    with Journal(pathname, clock=clock) as journal:
+        device = Device(PasswordStore(str(store_pathname), iterations=1000), clock, tracer=journal.tracer(0))
+        device.replay(LOGIN + CHANGE_PASSWORD)
+        device.shutdown()
+
+    with open(pathname, 'rb') as journal_file:
+        assert PASSWORD.encode() not in journal_file.read()
+    with JournalReader(pathname) as reader:
+        signals = [record[5] for record in reader if record[2] in (KEY, TRANSITION)]
+        assert not set(signals) & {key.encode() for key in PASSWORD}
+        assert signals.count(MASKED_DIGIT) == 2 * 2 * len(PASSWORD)
+        # Only the wake-up key and the keys ending each entry are left
+        assert ''.join(key for _, key in reader.key_trace(0)) == '0***'
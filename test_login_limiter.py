@@ -0,0 +1,30 @@
+""" Tests of the login lockout when the wall clock is set back """
+from login_limiter import LoginLimiter
+
+
+class SteppedClock:
+    """ Wall clock that only moves when the test sets it """
+
+    def __init__(self, time):
+        self.time = time
+
+    def wall_time(self):
+        return self.time
+
+
+def test_clock_set_back_caps_lockout(tmp_path):
+    pathname = str(tmp_path / 'lockout.txt')
+    clock = SteppedClock(1e9)
+    limiter = LoginLimiter(pathname, clock, table=(0, 8, 300))
+    assert limiter.record_failure() == 8
+
+    # A day back, and the lockout still ends within the longest in the table
+    clock.time -= 86400
+    assert limiter.remaining() == 300
+    clock.time += 299
+    assert limiter.remaining() == 1
+    clock.time += 1
+    assert limiter.remaining() == 0
+
+    # The shortened lockout was persisted
+    assert LoginLimiter(pathname, clock).locked_until == 1e9 - 86400 + 300
@@ -0,0 +1,147 @@
+""" Instrumentation hooks for the FSM, KPC and LED board. An FSM or LED
+board given a tracer reports every transition, signal wait, LED animation
+and LED job to it; without one (the default) nothing is measured at all """
+import bisect
+import sys
+import threading
+
+from password_store import write_atomic
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+
+
+class Tracer:
+    """ Tracer interface. Subclasses override the hooks they care about """
+
+    def transition(self, state_1, state_2, action, seconds):
+        """ A rule fired: the FSM went from state_1 to state_2 and
+        the agent action took seconds """
+
+    def signal_wait(self, state, signal, seconds):
+        """ The FSM waited seconds in state for its next signal, signal """
+
+    def no_match(self, state, signal):
+        """ No rule matched signal in state """
+
+    def animation(self, name, seconds):
+        """ An LED animation ran for seconds (on the board's clock) """
+
+    def led_job(self, led, seconds):
+        """ An LED was lit for seconds by a timed job """
+
+
+class Histogram:
+    """ Cumulative histogram in the Prometheus sense """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """ Constructor """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # The last one counts values above all bounds
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Add one observation """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """ Return the Prometheus text lines for this histogram """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', str(bound)),)), cumulative))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels), self.sum))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), self.count))
+        return lines
+
+
+def format_labels(labels):
+    """ Format ((name, value), ...) as a Prometheus label set """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class PrometheusTracer(Tracer):
+    """ Tracer that keeps counters and histograms of everything it is told
+    and exports them in the Prometheus text format """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """ Constructor """
+        self.buckets = buckets
+        self.__lock = threading.Lock()          # The animator reports from its own thread
+        self.__transitions = {}                 # (state_1, state_2, action) -> Histogram
+        self.__signal_wait = Histogram(buckets)
+        self.__no_match = {}                    # (state, signal) -> count
+        self.__animations = {}                  # name -> Histogram
+        self.__led_jobs = {}                    # LED -> count
+
+    def transition(self, state_1, state_2, action, seconds):
+        with self.__lock:
+            key = (state_1, state_2, action)
+            if key not in self.__transitions:
+                self.__transitions[key] = Histogram(self.buckets)
+            self.__transitions[key].observe(seconds)
+
+    def signal_wait(self, state, signal, seconds):
+        with self.__lock:
+            self.__signal_wait.observe(seconds)
+
+    def no_match(self, state, signal):
+        with self.__lock:
+            self.__no_match[state, signal] = self.__no_match.get((state, signal), 0) + 1
+
+    def animation(self, name, seconds):
+        with self.__lock:
+            if name not in self.__animations:
+                self.__animations[name] = Histogram(self.buckets)
+            self.__animations[name].observe(seconds)
+
+    def led_job(self, led, seconds):
+        with self.__lock:
+            self.__led_jobs[led] = self.__led_jobs.get(led, 0) + 1
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format """
+        with self.__lock:
+            lines = ['# HELP kpc_transition_seconds Time spent in the agent action of a transition',
+                     '# TYPE kpc_transition_seconds histogram']
+            for (state_1, state_2, action), histogram in sorted(self.__transitions.items()):
+                lines += histogram.render('kpc_transition_seconds',
+                                          (('from', state_1), ('to', state_2), ('action', action)))
+
+            lines += ['# HELP kpc_signal_wait_seconds Time the FSM waited for its next signal',
+                      '# TYPE kpc_signal_wait_seconds histogram']
+            lines += self.__signal_wait.render('kpc_signal_wait_seconds', ())
+
+            lines += ['# HELP kpc_unmatched_signals_total Signals no rule matched',
+                      '# TYPE kpc_unmatched_signals_total counter']
+            for (state, signal), count in sorted(self.__no_match.items()):
+                lines.append('kpc_unmatched_signals_total%s %d' %
+                             (format_labels((('state', state), ('signal', signal))), count))
+
+            lines += ['# HELP kpc_led_animation_seconds Time from starting an LED animation until it finished',
+                      '# TYPE kpc_led_animation_seconds histogram']
+            for name, histogram in sorted(self.__animations.items()):
+                lines += histogram.render('kpc_led_animation_seconds', (('animation', name),))
+
+            lines += ['# HELP kpc_led_jobs_total Timed LED jobs started',
+                      '# TYPE kpc_led_jobs_total counter']
+            for led, count in sorted(self.__led_jobs.items()):
+                lines.append('kpc_led_jobs_total%s %d' % (format_labels((('led', led),)), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, stream=None):
+        """ Write the metrics to stream, stdout by default """
+        (stream or sys.stdout).write(self.render())
+
+    def write(self, pathname):
+        """ Atomically replace the file pathname with the metrics, e.g. for
+        the textfile collector of the Prometheus node exporter """
+        write_atomic(pathname, self.render())